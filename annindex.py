@@ -0,0 +1,139 @@
+import numpy as np
+
+import retrieval
+
+
+# class IVFIndex
+#
+# Approximate nearest neighbour index for the combined histograms of the both method
+#
+# The images are split into clusters with k-medians (the L1 counterpart of k-means, so the clusters
+# match the Manhattan distance used for retrieval) and every cluster keeps an inverted list of its images
+# The clustering weighs the features like the both method does (by the inverse of their standard deviation),
+# which gives the clusters of the Gaussian normalized histograms without building that matrix
+# A query is compared with the cluster centres first, only the images of the nprobe closest clusters
+# are scored, and those candidates are re-ranked with the exact weighted Manhattan distance
+# nprobe is the recall/speed knob: probing every cluster gives the exact ranking
+#
+# The inverted lists are stored as one array of image indices grouped by cluster plus the start offset
+# of every cluster, and the features are reordered the same way so each probed list is a contiguous block
+class IVFIndex:
+
+    # init
+    #
+    # Sets the number of clusters (defaults to about the square root of the library size when built)
+    # and the default number of clusters probed per query
+    # The clusters are trained on a random sample of samplesPerList images per cluster
+    def __init__(self, numLists=None, nprobe=8, iterations=10, samplesPerList=64, seed=0):
+        self.numLists = numLists
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.samplesPerList = samplesPerList
+        self.seed = seed
+        self.centroids = None
+        self.listIndices = None
+        self.listOffsets = None
+        self.listFeatures = None
+
+    # build
+    #
+    # Clusters the feature matrix with the Manhattan distance weighted by weights and fills the inverted lists
+    def build(self, features, weights=None):
+        features = np.ascontiguousarray(features, dtype=float)
+        numImages = len(features)
+        numLists = min(self.numLists or max(1, int(round(np.sqrt(numImages)))), numImages)
+
+        # Start from randomly chosen images and refine with a few rounds of k-medians on a sample
+        rng = np.random.default_rng(self.seed)
+        sample = features[np.sort(rng.choice(numImages, min(numImages, numLists * self.samplesPerList),
+                                                         replace=False))]
+        centroids = sample[rng.choice(len(sample), numLists, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignment = self.assign(sample, centroids, weights)
+            order = np.argsort(assignment, kind='stable')
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=numLists))))
+            for cluster in np.flatnonzero(np.diff(offsets)):
+                centroids[cluster] = np.median(sample[order[offsets[cluster]:offsets[cluster + 1]]], axis=0)
+
+        assignment = self.assign(features, centroids, weights)
+        self.centroids = centroids
+        self.listIndices = np.argsort(assignment, kind='stable')
+        self.listOffsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=numLists))))
+        self.listFeatures = features[self.listIndices]
+        return self
+
+    # assign
+    #
+    # Returns the closest cluster centre of every row
+    @staticmethod
+    def assign(features, centroids, weights=None, chunkRows=4096):
+        assignment = np.empty(len(features), dtype=np.int64)
+        for start in range(0, len(features), chunkRows):
+            distances = retrieval.l1Distances(features[start:start + chunkRows], centroids, weights)
+            assignment[start:start + chunkRows] = np.argmin(distances, axis=1)
+        return assignment
+
+    # search
+    #
+    # Finds the k nearest images to a query vector
+    # Probes the nprobe closest clusters and re-ranks their images with the exact weighted Manhattan distance
+    # exclude is an image index left out of the results, usually the query image itself
+    # Returns (indices, distances) ranked closest first
+    def search(self, query, k, weights=None, nprobe=None, exclude=None):
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+
+        centroidDistances = retrieval.l1Distances(query, self.centroids, weights)[0]
+        probed = np.argpartition(centroidDistances, nprobe - 1)[:nprobe]
+
+        blocks = [slice(self.listOffsets[cluster], self.listOffsets[cluster + 1]) for cluster in probed]
+        candidates = np.concatenate([self.listIndices[block] for block in blocks])
+        candidateFeatures = np.concatenate([self.listFeatures[block] for block in blocks])
+
+        distances = retrieval.l1Distances(query, candidateFeatures, weights)
+        if exclude is not None:
+            distances[0, candidates == exclude] = np.nan
+
+        order, rankedDistances = retrieval.topK(distances, k)
+        keep = ~np.isnan(rankedDistances[0])
+        return candidates[order[0][keep]], rankedDistances[0][keep]
+
+    # save
+    #
+    # Saves the clusters and inverted lists to a .npz file together with the fingerprint of the feature index
+    # they were built from
+    def save(self, path, fingerprint=None):
+        np.savez(path, centroids=self.centroids, listIndices=self.listIndices,
+                 listOffsets=self.listOffsets, listFeatures=self.listFeatures, nprobe=self.nprobe,
+                 fingerprint=fingerprint or "")
+
+    # load
+    #
+    # Loads an index saved with save, or returns None if it was built from another feature index
+    # (or saved without a fingerprint) when the fingerprint of the current one is given
+    @classmethod
+    def load(cls, path, fingerprint=None):
+        with np.load(path) as data:
+            if fingerprint is not None and str(data.get('fingerprint', "")) != fingerprint:
+                return None
+            index = cls(numLists=len(data['centroids']), nprobe=int(data['nprobe']))
+            index.centroids = data['centroids']
+            index.listIndices = data['listIndices']
+            index.listOffsets = data['listOffsets']
+            index.listFeatures = data['listFeatures']
+        return index
+
+
+# measureRecall
+#
+# Measures recall@k of the index against the exact ranking for the given query images
+# Recall is the fraction of the exact k nearest images that the approximate search also returns,
+# averaged over the queries, both ranked with the given feature weights
+def measureRecall(index, features, queryIndices, k=20, nprobe=None, weights=None):
+    exact, _ = retrieval.topK(
+        retrieval.l1Distances(features[queryIndices], features, weights), k, exclude=queryIndices)
+
+    found = 0
+    for row, queryIndex in enumerate(queryIndices):
+        approximate, _ = index.search(features[queryIndex], k, weights, nprobe, exclude=queryIndex)
+        found += len(np.intersect1d(approximate, exact[row]))
+    return found / exact.size
@@ -0,0 +1,407 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import numpy as np
+from PIL import Image
+
+import histograms as histogramEngine
+import retrieval
+from extraction import defaultWorkers
+from featurestore import FeatureStore, listImages
+from imageindex import ImageIndex
+from thumbnails import ThumbnailCache
+
+
+# bench
+#
+# Reproducible benchmark of the retrieval pipeline on synthetic image libraries
+#
+# Generates a library of random photo-like JPEG images (kept under the work folder and reused by later
+# runs with the same settings), then times every stage the application goes through:
+#     decode        opening and converting images to RGB pixels
+#     histogram     binning decoded pixels into intensity and color code histograms
+#     index         building the feature index of the whole library with the extraction workers
+#     normalization preparing the normalized matrices and the combined method statistics and weights
+#     distance      distance of every image to a query, per method
+#     ranking       ranking the first page of a query and ranking the whole library
+#     thumbnail     generating thumbnails with an empty cache and reading them from a warm one
+#     display       redrawing the image grid at random scroll positions (with --gui and a display only)
+# Every stage reports its throughput, per item latency and the peak memory allocated while it ran
+# Stages are timed untraced and run a second time under tracemalloc for their peak memory, since tracing
+# slows Python code down enough to distort the timings
+# The reference stages time the original per-pixel histogram loops on a small part of the sample and the
+# original per-image Manhattan distance loops over dictionaries of histograms, as the baseline the
+# vectorized stages are compared against:
+#     reference.histogram           per-pixel intensity and color code loops
+#     reference.distance.<method>   per-image manhattanDistance calls for the intensity and color code methods
+# The rankings of the image index are also checked against rankings computed straight from int64
+# histogram counts in float64, so compact storage can never change a result unnoticed
+#
+# Results are written as JSON, and a previous result file can be given as the baseline to report the
+# change of every stage against it and fail when a stage became slower than the tolerance allows
+#     python bench.py --images 1000 --output results.json
+#     python bench.py --images 1000 --baseline results.json --tolerance 1.2
+
+METHOD_MATRICES = {'intensity': 'normalizedIntensity', 'colorCode': 'normalizedColorCode'}
+
+
+# generateLibrary
+#
+# Writes numImages synthetic JPEG images of the given size to a folder, skipping ones that already exist
+# Each image is a blurred random color field with noise, so its histograms vary like those of photos
+def generateLibrary(folder, numImages, size=(384, 256), seed=0):
+    os.makedirs(folder, exist_ok=True)
+    for i in range(numImages):
+        path = os.path.join(folder, f"{i + 1}.jpg")
+        if os.path.exists(path):
+            continue
+
+        rng = np.random.default_rng((seed, i))
+        coarse = rng.integers(0, 256, (4, 6, 3), dtype=np.uint8)
+        img = Image.fromarray(coarse).resize(size, Image.BILINEAR)
+        noise = rng.integers(-24, 25, (size[1], size[0], 3))
+        pixels = np.clip(np.asarray(img, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+        Image.fromarray(pixels).save(path, quality=85)
+    return listImages(folder)
+
+
+# tracedPeak
+#
+# Runs work() again under tracemalloc and returns the peak memory it allocated in bytes
+def tracedPeak(work):
+    tracemalloc.start()
+    try:
+        work()
+        _, peakBytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peakBytes
+
+
+# measure
+#
+# Times one untraced run of work(), then runs it a second time to trace the peak memory it allocates
+# work() has to start from the same state on every call, stages with caches build them inside work()
+# Returns (result, stage) where result is from the timed run and stage holds the seconds, items per second,
+# milliseconds per item and peak bytes
+def measure(work, items):
+    start = time.perf_counter()
+    result = work()
+    seconds = time.perf_counter() - start
+    peakBytes = tracedPeak(work)
+    return result, {'seconds': seconds, 'items': items, 'perSecond': items / seconds if seconds else None,
+                    'msPerItem': 1000 * seconds / items if items else None, 'peakBytes': peakBytes}
+
+
+# latencies
+#
+# Times work(query) for every query and summarizes the latencies in milliseconds
+# The queries are timed untraced, the peak memory is traced over a second pass of all the queries
+def latencies(work, queries):
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        work(query)
+        times.append(time.perf_counter() - start)
+
+    seconds = sum(times)
+    stage = {'seconds': seconds, 'items': len(queries), 'perSecond': len(queries) / seconds if seconds else None,
+             'msPerItem': 1000 * seconds / len(queries) if queries else None,
+             'peakBytes': tracedPeak(lambda: [work(query) for query in queries])}
+    times = 1000 * np.array(times)
+    stage.update(p50Ms=float(np.percentile(times, 50)), p95Ms=float(np.percentile(times, 95)),
+                 maxMs=float(np.max(times)))
+    return stage
+
+
+# benchImages
+#
+# Decode, histogram and thumbnail stages on a sample of the library
+def benchImages(paths, results):
+    pixels, results['decode'] = measure(lambda: [histogramEngine.toPixels(Image.open(path)) for path in paths],
+                                        len(paths))
+    _, results['histogram'] = measure(
+        lambda: [histogramEngine.intensityAndColorCodeHistograms(image) for image in pixels], len(paths))
+    del pixels
+
+    def thumbnails():
+        cache = ThumbnailCache()
+        for path in paths:
+            cache.get(path, (197, 143))
+        return cache
+
+    cache, results['thumbnail'] = measure(thumbnails, len(paths))
+    _, results['thumbnailCached'] = measure(lambda: [cache.peek(path, (197, 143)) for path in paths], len(paths))
+
+
+# benchIndex
+#
+# Builds the feature index of the whole library in a temporary folder
+def benchIndex(paths, workers, results):
+    with tempfile.TemporaryDirectory() as indexFolder:
+        def build():
+            store = FeatureStore(tempfile.mkdtemp(dir=indexFolder))
+            store.update(paths, workers=workers)
+            return store.indexFolder
+
+        storeFolder, results['index'] = measure(build, len(paths))
+        store = FeatureStore(storeFolder)
+        return np.array(store.intensity), np.array(store.colorCode)
+
+
+# referenceHistograms
+#
+# Intensity and color code histograms of decoded pixels computed one pixel at a time, the way the viewer
+# originally did
+def referenceHistograms(pixels):
+    intensity = np.zeros(histogramEngine.INTENSITY_BINS, dtype=int)
+    colorCode = np.zeros(histogramEngine.COLOR_CODE_BINS, dtype=int)
+    for r, g, b in pixels.reshape(-1, 3):
+        value = 0.299 * r + 0.587 * g + 0.114 * b
+        intensity[min(int(value) // 10, 24)] += 1
+        colorCode[(r // 64) * 16 + (g // 64) * 4 + (b // 64)] += 1
+    return intensity, colorCode
+
+
+# benchReference
+#
+# Times the original per-pixel histogram loops on a part of the sample and the original per-image distance
+# loops over dictionaries of histogram counts
+def benchReference(paths, intensity, colorCode, queries, results):
+    pixels = [histogramEngine.toPixels(Image.open(path)) for path in paths]
+    _, results['reference.histogram'] = measure(lambda: [referenceHistograms(image) for image in pixels],
+                                                len(paths))
+    del pixels
+
+    for method, counts in (('intensity', intensity), ('colorCode', colorCode)):
+        histograms = {i: histogram for i, histogram in enumerate(counts)}
+        pixelCounts = {i: np.sum(histogram) for i, histogram in histograms.items()}
+
+        def distances(q):
+            return sorted((retrieval.manhattanDistance(histograms[q], histogram, pixelCounts[q], pixelCounts[i]), i)
+                          for i, histogram in histograms.items() if i != q)
+
+        results[f'reference.distance.{method}'] = latencies(distances, queries)
+
+
+# benchRetrieval
+#
+# Normalization, distance and ranking stages over the indexed library
+def benchRetrieval(paths, intensity, colorCode, queries, results):
+    def normalize():
+        imageIndex = ImageIndex(paths, intensity, colorCode)
+        imageIndex.normalizedHistograms()
+        imageIndex.bothMethodsWeights()
+        return imageIndex
+
+    imageIndex, results['normalization'] = measure(normalize, len(paths))
+
+    for method in retrieval.METHODS:
+        if method == "both":
+            results['distance.both'] = latencies(lambda q: imageIndex.bothMethodsDistances(q), queries)
+        else:
+            matrix = getattr(imageIndex, METHOD_MATRICES[method])
+            results[f'distance.{method}'] = latencies(lambda q: retrieval.histogramDistances(matrix, q), queries)
+
+    relevant = queries[:4]
+    results['distance.bothRelevant'] = latencies(lambda q: imageIndex.bothMethodsDistances(q, relevant), queries)
+
+    distances = {q: imageIndex.bothMethodsDistances(q) for q in queries}
+    results['ranking.firstPage'] = latencies(lambda q: retrieval.Ranking(distances[q], q)[:20], queries)
+    results['ranking.full'] = latencies(lambda q: retrieval.topK(distances[q], None, exclude=[q]), queries)
+    return imageIndex
+
+
+# checkRankings
+#
+# Compares the full rankings of every method on the image index with rankings computed from int64 counts
+# by the reference functions of the retrieval module, which score the both method on the Gaussian normalized
+# matrix rather than with the standard deviation folded into the weights
+# Returns the number of queries whose ranking differs for any method
+def checkRankings(imageIndex, intensity, colorCode, queries):
+    intensity = np.asarray(intensity, dtype=np.int64)
+    colorCode = np.asarray(colorCode, dtype=np.int64)
+    normalizedIntensity = retrieval.normalizeHistograms(intensity)
+    normalizedColorCode = retrieval.normalizeHistograms(colorCode)
+    normalizedFeatures = retrieval.normalizeFeatures(histogramEngine.combinedFeature(intensity, colorCode))
+    reference = {
+        'intensity': lambda q: retrieval.retrieveByIntensity(normalizedIntensity, q),
+        'colorCode': lambda q: retrieval.retrieveByColorCode(normalizedColorCode, q),
+        'both': lambda q: retrieval.retrieveByBothMethods(normalizedFeatures, q),
+    }
+
+    mismatches = 0
+    for q in queries:
+        for method in retrieval.METHODS:
+            if method == "both":
+                distances = imageIndex.bothMethodsDistances(q)
+            else:
+                distances = retrieval.histogramDistances(getattr(imageIndex, METHOD_MATRICES[method]), q)
+            ranked, _ = retrieval.topK(distances, None, exclude=[q])
+            expected, _ = reference[method](q)
+            if not np.array_equal(ranked[0], expected):
+                mismatches += 1
+                break
+    return mismatches
+
+
+# benchDisplay
+#
+# Redraws the image grid of the viewer at random scroll positions after its thumbnails are cached
+# Needs tkinter and a display, the stage is skipped otherwise
+def benchDisplay(paths, imageIndex, queries, results):
+    try:
+        import tkinter as tk
+        from gui import ImageViewer
+        root = tk.Tk()
+    except Exception as error:
+        results['display'] = {'skipped': str(error)}
+        return
+
+    with tempfile.TemporaryDirectory() as workFolder:
+        currentFolder = os.getcwd()
+        os.chdir(workFolder)
+        os.makedirs("images")
+        try:
+            viewer = ImageViewer(root)
+            viewer.indexThread.join()
+            viewer.imagePaths = [os.path.join(currentFolder, path) for path in paths]
+            viewer.sortedImages = retrieval.Ranking(imageIndex.bothMethodsDistances(queries[0]), queries[0])
+            rng = np.random.default_rng(0)
+            offsets = rng.integers(0, max(1, len(paths) // viewer.gridColumns) * viewer.cellSize[1], len(queries))
+            for offset in offsets:
+                viewer.scrollTo(offset)
+                for cell in viewer.gridCells:
+                    if cell['imagePath']:
+                        viewer.thumbnailCache.get(cell['imagePath'], viewer.thumbnailSize)
+
+            def redraw(offset):
+                viewer.scrollTo(offset)
+                root.update_idletasks()
+
+            results['display'] = latencies(redraw, list(offsets))
+            viewer.close()
+        finally:
+            os.chdir(currentFolder)
+            root.destroy()
+
+
+# compareBaseline
+#
+# Prints the change of every stage against a baseline result file
+# Returns the stages that are slower than the baseline by more than the tolerance, the reference stages
+# time the original code paths and never count as regressions
+def compareBaseline(results, baseline, tolerance):
+    regressions = []
+    for name, stage in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if not base or 'seconds' not in stage or 'seconds' not in base:
+            continue
+
+        ratio = stage['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+        print(f"{name:30}{base['seconds']:10.4f}s ->{stage['seconds']:10.4f}s  x{ratio:.2f}", file=sys.stderr)
+        if ratio > tolerance and not name.startswith('reference.'):
+            regressions.append(name)
+    return regressions
+
+
+# printStages
+#
+# Prints a table of the measured stages on stderr
+def printStages(stages):
+    print(f"{'stage':30}{'seconds':>10}{'items/s':>12}{'ms/item':>10}{'peak MB':>10}", file=sys.stderr)
+    for name, stage in stages.items():
+        if 'skipped' in stage:
+            print(f"{name:30}skipped: {stage['skipped']}", file=sys.stderr)
+            continue
+        print(f"{name:30}{stage['seconds']:10.4f}{stage['perSecond']:12.1f}{stage['msPerItem']:10.3f}"
+              f"{stage['peakBytes'] / 2 ** 20:10.1f}", file=sys.stderr)
+
+
+# main
+#
+# Parses the command line, runs every stage and writes the results
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark extraction, indexing, retrieval and rendering")
+    parser.add_argument("--images", type=int, default=1000, help="number of images in the synthetic library")
+    parser.add_argument("--size", type=int, nargs=2, default=(384, 256), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sample", type=int, default=200, help="images used by the decode and thumbnail stages")
+    parser.add_argument("--queries", type=int, default=50, help="queries timed by the retrieval stages")
+    parser.add_argument("--reference-sample", type=int, default=5,
+                        help="sample images timed by the per-pixel reference histogram stage")
+    parser.add_argument("--workers", type=int, default=None, help="number of extraction processes")
+    parser.add_argument("--work-folder", default="bench", help="folder the synthetic libraries are kept in")
+    parser.add_argument("--gui", action="store_true", help="also time redrawing the image grid")
+    parser.add_argument("--engine", choices=retrieval.ENGINES, default="numpy", help="distance evaluation engine")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout by default")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="slowdown against the baseline that fails")
+    args = parser.parse_args(argv)
+    try:
+        retrieval.setDistanceEngine(args.engine)
+    except ValueError as error:
+        parser.error(str(error))
+
+    width, height = args.size
+    libraryFolder = os.path.join(args.work_folder, f"library-{args.images}-{width}x{height}-{args.seed}")
+    print(f"Generating {args.images} images in {libraryFolder}", file=sys.stderr)
+    paths = generateLibrary(libraryFolder, args.images, (width, height), args.seed)[:args.images]
+
+    rng = np.random.default_rng(args.seed)
+    sample = [paths[i] for i in np.sort(rng.choice(len(paths), min(args.sample, len(paths)), replace=False))]
+    queries = [int(q) for q in rng.choice(len(paths), min(args.queries, len(paths)), replace=False)]
+
+    stages = {}
+    benchImages(sample, stages)
+    intensity, colorCode = benchIndex(paths, args.workers, stages)
+    imageIndex = benchRetrieval(paths, intensity, colorCode, queries, stages)
+    benchReference(sample[:args.reference_sample], intensity, colorCode, queries, stages)
+    mismatches = checkRankings(imageIndex, intensity, colorCode, queries)
+    if args.gui:
+        benchDisplay(paths, imageIndex, queries, stages)
+
+    results = {
+        'config': {'images': args.images, 'size': [width, height], 'seed': args.seed, 'sample': len(sample),
+                   'queries': len(queries), 'referenceSample': len(sample[:args.reference_sample]),
+                   'workers': args.workers or defaultWorkers(), 'engine': args.engine},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'maxRssKb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        'childMaxRssKb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource else None,
+        'stages': stages,
+        'rankingCheck': {'queries': len(queries), 'mismatches': mismatches},
+    }
+
+    printStages(stages)
+    print(f"Rankings checked for {len(queries)} queries, {mismatches} differ", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if mismatches:
+        raise SystemExit(f"Rankings of {mismatches} queries differ from the int64 reference")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareBaseline(results, json.load(f), args.tolerance)
+        if regressions:
+            raise SystemExit(f"Slower than the baseline: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from annindex import IVFIndex, measureRecall
+from extraction import extractFeatures
+from featurestore import FeatureStore, listImages
+import histograms as histogramEngine
+from imageindex import ImageIndex
+from neighbours import NeighbourGraph
+import retrieval
+import timing
+
+
+# cli
+#
+# Command line entry point for headless retrieval, without importing tkinter
+#
+# index: builds or refreshes the feature index of an image folder
+#     python cli.py index images
+# query: answers top-k queries for one or more images of the index, or for every image with --all
+#     python cli.py query 5.jpg 17.jpg --method colorCode --top-k 10
+#     python cli.py query --all --method both --format json > neighbours.json
+# ann: builds the approximate nearest neighbour index of the both method and measures its recall
+#     python cli.py ann build --lists 256
+#     python cli.py ann recall --nprobe 1 2 4 8
+#     python cli.py query 5.jpg --ann --nprobe 4
+# neighbours: precomputes the top-k neighbours of every image for the three methods, which default
+# queries (no relevant images) with --graph, the viewer and the server then answer by lookup
+#     python cli.py neighbours build --k 50
+#     python cli.py query 5.jpg --graph --method colorCode
+# --fine re-ranks the candidates of a query by a finer histogram held in the index (coarse-to-fine cascade)
+#     python cli.py index images --fine color12 --fine grid2x2
+#     python cli.py query 5.jpg --method both --fine color12 --candidates 200
+# match: finds the top-k indexed images for external query images (files or folders) that are not in the index
+#     python cli.py match incoming/ --method both --top-k 5 --format csv --output matches.csv
+#     python cli.py match photo1.jpg photo2.jpg --max-distance 0.05
+# --trace prints the time spent in every stage to stderr and appends it to a JSON lines file,
+# --profile saves cProfile statistics of the command to a folder
+#     python cli.py --trace trace.jsonl --profile profiles query --all
+
+QUERY_BATCH = 256
+
+
+# printProgress
+#
+# Prints the extraction progress on a single line of stderr
+def printProgress(done, total, label="Indexing"):
+    print(f"\r{label} {done} / {total}", end="" if done < total else "\n", file=sys.stderr)
+
+
+# resolveImages
+#
+# Maps image names or paths given on the command line to rows of the index
+def resolveImages(store, names):
+    rows = {}
+    for row, path in enumerate(store.paths):
+        rows[path] = row
+        rows[os.path.normpath(path)] = row
+        rows.setdefault(os.path.basename(path), row)
+
+    indices = []
+    for name in names:
+        row = rows.get(name, rows.get(os.path.normpath(name)))
+        if row is None:
+            raise SystemExit(f"Image {name!r} is not in the index")
+        indices.append(row)
+    return indices
+
+
+# indexCommand
+#
+# Updates the feature index with the images of a folder
+# Images that cannot be decoded are reported on stderr and left out
+def indexCommand(args):
+    store = FeatureStore(args.index_folder, args.fine)
+    imagePaths = listImages(args.image_folder)
+    decoded = store.update(imagePaths, progress=printProgress, workers=args.workers, skipErrors=True)
+    for path in store.failed:
+        print(f"Skipping {path}, it could not be decoded", file=sys.stderr)
+    print(f"Indexed {len(store.paths)} images ({decoded} decoded) into {args.index_folder}")
+
+
+# loadStore
+#
+# Opens the feature index, exiting with a message if it has not been built yet
+def loadStore(indexFolder):
+    store = FeatureStore(indexFolder)
+    if not store.paths:
+        raise SystemExit(f"No feature index in {indexFolder}, run the index command first")
+    return store
+
+
+# positiveInt
+#
+# Checks a count given on the command line (number of results, candidates, workers...) is at least 1
+def positiveInt(text):
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{text!r} is not a whole number")
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"{value} must be at least 1")
+    return value
+
+
+# quantizationSpec
+#
+# Checks a --fine quantization spec while the command line is parsed
+def quantizationSpec(spec):
+    try:
+        return histogramEngine.Quantization(spec).spec
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+# fineCounts
+#
+# Finer histogram counts of a spec held by the index, exiting with a message if the index has none
+def fineCounts(store, spec):
+    if spec not in store.fine:
+        raise SystemExit(f"No {spec} histograms in the index, run the index command with --fine {spec} first")
+    return store.fine[spec]
+
+
+# numCandidates
+#
+# Number of coarse candidates re-ranked by the fine histograms, ten times the requested results by default
+def numCandidates(args):
+    return args.candidates or 10 * args.top_k
+
+
+# graphPath
+#
+# File the neighbour graph is saved to
+def graphPath(indexFolder):
+    return os.path.join(indexFolder, NeighbourGraph.FILE)
+
+
+# annPath
+#
+# File the approximate nearest neighbour index is saved to
+def annPath(indexFolder):
+    return os.path.join(indexFolder, "ann.npz")
+
+
+# loadAnnIndex
+#
+# Loads the approximate nearest neighbour index, exiting with a message if it is missing or was built
+# before the feature index changed
+def loadAnnIndex(store):
+    if not os.path.exists(annPath(store.indexFolder)):
+        raise SystemExit("No approximate index, run the ann build command first")
+    index = IVFIndex.load(annPath(store.indexFolder), store.fingerprint)
+    if index is None:
+        raise SystemExit("The approximate index was built for an older feature index, rebuild it with ann build")
+    return index
+
+
+# queryCommand
+#
+# Retrieves the top-k images for every query and prints them as text or JSON
+def queryCommand(args):
+    store = loadStore(args.index_folder)
+    queries = list(range(len(store.paths))) if args.all else resolveImages(store, args.images)
+    relevantIndices = resolveImages(store, args.relevant)
+    if relevantIndices and args.method != "both":
+        raise SystemExit("--relevant only applies to the both method")
+
+    # Graph queries look the neighbours up without building the image index, approximate queries on the both
+    # method only score the probed clusters, the other queries are scored in batches sharing one distance pass
+    imageIndex = None if args.graph else ImageIndex(store.paths, store.intensity, store.colorCode)
+    if args.graph:
+        if relevantIndices or args.ann or args.fine:
+            raise SystemExit("--graph only answers queries without --relevant, --ann or --fine")
+        ranked = graphQueries(args, store, queries)
+    elif args.ann:
+        if args.method != "both":
+            raise SystemExit("--ann only applies to the both method")
+        if args.fine:
+            raise SystemExit("--fine cannot be combined with --ann")
+        ranked = annQueries(args, store, imageIndex, queries, relevantIndices)
+    elif args.fine:
+        ranked = fineQueries(args, store, imageIndex, queries, relevantIndices)
+    else:
+        ranked = indexQueries(args, imageIndex, queries, relevantIndices)
+
+    results = {}
+    for queryIndex, (indices, distances) in zip(queries, ranked):
+        results[store.paths[queryIndex]] = [
+            {'path': store.paths[index], 'distance': float(distance)} for index, distance in zip(indices, distances)]
+
+    if args.format == "json":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    for query, matches in results.items():
+        for rank, match in enumerate(matches, 1):
+            print(f"{query}\t{rank}\t{match['path']}\t{match['distance']:.6f}")
+
+
+# indexQueries
+#
+# Answers queries by scanning the image index, QUERY_BATCH queries at a time in a single distance pass
+def indexQueries(args, imageIndex, queries, relevantIndices):
+    for start in range(0, len(queries), QUERY_BATCH):
+        batch = queries[start:start + QUERY_BATCH]
+        distances = imageIndex.queryDistances(args.method, imageIndex.featuresOf(batch), relevantIndices)
+        yield from zip(*retrieval.topK(distances, args.top_k, exclude=np.asarray(batch)))
+
+
+# graphQueries
+#
+# Answers queries by looking up their neighbours in the saved neighbour graph
+def graphQueries(args, store, queries):
+    graph = NeighbourGraph.load(graphPath(args.index_folder), store.fingerprint)
+    if graph is None:
+        raise SystemExit("No neighbour graph for this index, run the neighbours build command first")
+    if args.top_k > graph.k:
+        raise SystemExit(f"The neighbour graph holds {graph.k} neighbours per image, rebuild it with --k {args.top_k}")
+    for queryIndex in queries:
+        yield graph.neighbours(args.method, queryIndex, args.top_k)
+
+
+# neighboursCommand
+#
+# Builds the neighbour graph of the index and saves it next to the index
+def neighboursCommand(args):
+    store = loadStore(args.index_folder)
+    imageIndex = ImageIndex(store.paths, store.intensity, store.colorCode)
+    start = time.perf_counter()
+    graph = NeighbourGraph(args.k).build(imageIndex, workers=args.workers)
+    graph.save(graphPath(args.index_folder), store.fingerprint)
+    print(f"Built the {args.k} nearest neighbours of {len(graph)} images for {len(retrieval.METHODS)} methods "
+          f"in {time.perf_counter() - start:.2f}s")
+
+
+# fineQueries
+#
+# Answers queries with the coarse-to-fine cascade: the coarse distances of the chosen method pick the
+# candidates, which are re-ranked by the finer histograms of the --fine spec
+def fineQueries(args, store, imageIndex, queries, relevantIndices):
+    fine = fineCounts(store, args.fine)
+    for start in range(0, len(queries), QUERY_BATCH):
+        batch = queries[start:start + QUERY_BATCH]
+        coarse = imageIndex.queryDistances(args.method, imageIndex.featuresOf(batch), relevantIndices)
+        yield from zip(*retrieval.cascadeRetrieve(coarse, fine, fine[batch], args.top_k, numCandidates(args),
+                                                  exclude=np.asarray(batch)))
+
+
+# externalImages
+#
+# Expands the files and folders given to the match command into a list of image paths
+def externalImages(names):
+    paths = []
+    for name in names:
+        if os.path.isdir(name):
+            paths.extend(listImages(name))
+        elif os.path.isfile(name):
+            paths.append(name)
+        else:
+            raise SystemExit(f"No image or folder {name!r}")
+    return paths
+
+
+# matchCommand
+#
+# Retrieves the top-k indexed images for every external query image
+# The query images are decoded in parallel by the extraction pipeline and scored against the index in
+# batches of QUERY_BATCH queries, each batch in a single distance pass
+# With --fine the finer histograms of the queries are computed in the same decode and re-rank the candidates
+# Images that cannot be decoded are reported on stderr and left out
+def matchCommand(args):
+    store = loadStore(args.index_folder)
+    imageIndex = ImageIndex(store.paths, store.intensity, store.colorCode)
+    relevantIndices = resolveImages(store, args.relevant)
+    if relevantIndices and args.method != "both":
+        raise SystemExit("--relevant only applies to the both method")
+    fine = fineCounts(store, args.fine) if args.fine else None
+
+    queryPaths = externalImages(args.images)
+    intensity, colorCode, *queryFine = extractFeatures(
+        queryPaths, workers=args.workers, skipErrors=True, specs=[args.fine] if args.fine else [],
+        progress=lambda done, total: printProgress(done, total, "Decoding"))
+    decoded = np.flatnonzero(np.sum(intensity, axis=1) > 0)
+    for row in np.setdiff1d(np.arange(len(queryPaths)), decoded):
+        print(f"Skipping {queryPaths[row]}, it could not be decoded", file=sys.stderr)
+
+    queryFeatures = histogramEngine.combinedFeature(intensity[decoded], colorCode[decoded])
+    results = {}
+    for start in range(0, len(decoded), QUERY_BATCH):
+        distances = imageIndex.queryDistances(args.method, queryFeatures[start:start + QUERY_BATCH], relevantIndices)
+        if fine is not None:
+            indices, distances = retrieval.cascadeRetrieve(
+                distances, fine, queryFine[0][decoded[start:start + QUERY_BATCH]], args.top_k, numCandidates(args))
+        else:
+            indices, distances = retrieval.topK(distances, args.top_k)
+        for row, rowIndices, rowDistances in zip(decoded[start:start + QUERY_BATCH], indices, distances):
+            keep = rowDistances <= args.max_distance if args.max_distance is not None else slice(None)
+            results[queryPaths[row]] = [{'path': store.paths[index], 'distance': float(distance)}
+                                        for index, distance in zip(rowIndices[keep], rowDistances[keep])]
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        if args.format == "json":
+            json.dump(results, output, indent=2)
+            output.write("\n")
+        else:
+            writer = csv.writer(output)
+            writer.writerow(("query", "rank", "match", "distance"))
+            for query, matches in results.items():
+                for rank, match in enumerate(matches, 1):
+                    writer.writerow((query, rank, match['path'], repr(match['distance'])))
+    finally:
+        if args.output:
+            output.close()
+
+
+# annQueries
+#
+# Answers queries of the both method with the saved approximate nearest neighbour index
+# The probed images are re-ranked with the weights of the both method, derived from the relevant images if any
+def annQueries(args, store, imageIndex, queries, relevantIndices):
+    index = loadAnnIndex(store)
+    weights = imageIndex.bothMethodsWeights(relevantIndices)
+    for queryIndex in queries:
+        yield index.search(imageIndex.featuresOf(queryIndex), args.top_k, weights, args.nprobe, exclude=queryIndex)
+
+
+# annCommand
+#
+# Builds the approximate nearest neighbour index, or reports its recall@k and query time against the
+# exact ranking for every given nprobe
+def annCommand(args):
+    store = loadStore(args.index_folder)
+    imageIndex = ImageIndex(store.paths, store.intensity, store.colorCode)
+    features = imageIndex.combinedFeatures()
+    weights = imageIndex.bothMethodsWeights()
+
+    if args.action == "build":
+        start = time.perf_counter()
+        index = IVFIndex(numLists=args.lists).build(features, weights)
+        index.save(annPath(args.index_folder), store.fingerprint)
+        print(f"Built {len(index.centroids)} lists over {len(features)} images "
+              f"in {time.perf_counter() - start:.2f}s")
+        return
+
+    index = loadAnnIndex(store)
+    rng = np.random.default_rng(0)
+    queries = rng.choice(len(features), min(args.queries, len(features)), replace=False)
+
+    start = time.perf_counter()
+    retrieval.topK(imageIndex.queryDistances("both", features[queries[:1]]), args.top_k)
+    print(f"exact\t\t{(time.perf_counter() - start) * 1000:.3f} ms/query")
+
+    for nprobe in args.nprobe:
+        start = time.perf_counter()
+        for queryIndex in queries:
+            index.search(features[queryIndex], args.top_k, weights, nprobe, exclude=queryIndex)
+        elapsed = (time.perf_counter() - start) / len(queries)
+        recall = measureRecall(index, features, queries, args.top_k, nprobe, weights)
+        print(f"nprobe {nprobe}\trecall@{args.top_k} {recall:.3f}\t{elapsed * 1000:.3f} ms/query")
+
+
+# main
+#
+# Parses the command line and runs the chosen command
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless content-based image retrieval")
+    parser.add_argument("--index-folder", default="index", help="folder holding the feature index")
+    parser.add_argument("--trace", help="JSON lines file the timing breakdown of the command is appended to")
+    parser.add_argument("--profile", help="folder cProfile statistics of the command are saved to")
+    parser.add_argument("--engine", choices=retrieval.ENGINES, default="numpy",
+                        help="how distances are evaluated, numexpr uses every core if it is installed")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    indexParser = commands.add_parser("index", help="index the images of a folder")
+    indexParser.add_argument("image_folder", nargs="?", default="images")
+    indexParser.add_argument("--workers", type=positiveInt, default=None, help="number of extraction processes")
+    indexParser.add_argument("--fine", action="append", default=[], type=quantizationSpec, metavar="SPEC",
+                             help="also keep a finer histogram, e.g. color8, color9, color12, hsv or grid2x2")
+    indexParser.set_defaults(run=indexCommand)
+
+    queryParser = commands.add_parser("query", help="retrieve the most similar images")
+    queryParser.add_argument("images", nargs="*", help="names or paths of indexed query images")
+    queryParser.add_argument("--all", action="store_true", help="query every indexed image")
+    queryParser.add_argument("--method", choices=retrieval.METHODS, default="both")
+    queryParser.add_argument("--top-k", type=positiveInt, default=20)
+    queryParser.add_argument("--relevant", nargs="*", default=[], help="relevant images for the both method")
+    queryParser.add_argument("--format", choices=("text", "json"), default="text")
+    queryParser.add_argument("--ann", action="store_true", help="use the approximate index for the both method")
+    queryParser.add_argument("--nprobe", type=positiveInt, default=None, help="clusters probed by the approximate index")
+    queryParser.add_argument("--graph", action="store_true", help="look the results up in the neighbour graph")
+    queryParser.add_argument("--fine", type=quantizationSpec, metavar="SPEC", help="re-rank the candidates by this finer histogram of the index")
+    queryParser.add_argument("--candidates", type=positiveInt, default=None,
+                             help="coarse candidates re-ranked by --fine, 10 x top-k by default")
+    queryParser.set_defaults(run=queryCommand)
+
+    matchParser = commands.add_parser("match", help="find indexed images similar to external images")
+    matchParser.add_argument("images", nargs="+", help="query image files or folders of images")
+    matchParser.add_argument("--method", choices=retrieval.METHODS, default="both")
+    matchParser.add_argument("--top-k", type=positiveInt, default=20)
+    matchParser.add_argument("--relevant", nargs="*", default=[], help="relevant indexed images for the both method")
+    matchParser.add_argument("--max-distance", type=float, default=None, help="only report closer matches")
+    matchParser.add_argument("--workers", type=positiveInt, default=None, help="number of extraction processes")
+    matchParser.add_argument("--format", choices=("csv", "json"), default="csv")
+    matchParser.add_argument("--output", help="file to write the matches to, stdout by default")
+    matchParser.add_argument("--fine", type=quantizationSpec, metavar="SPEC", help="re-rank the candidates by this finer histogram of the index")
+    matchParser.add_argument("--candidates", type=positiveInt, default=None,
+                             help="coarse candidates re-ranked by --fine, 10 x top-k by default")
+    matchParser.set_defaults(run=matchCommand)
+
+    neighboursParser = commands.add_parser("neighbours", help="precompute the neighbours of every image")
+    neighboursParser.add_argument("action", choices=("build",))
+    neighboursParser.add_argument("--k", type=positiveInt, default=50, help="neighbours kept per image and method")
+    neighboursParser.add_argument("--workers", type=positiveInt, default=None, help="number of threads")
+    neighboursParser.set_defaults(run=neighboursCommand)
+
+    annParser = commands.add_parser("ann", help="build or evaluate the approximate nearest neighbour index")
+    annParser.add_argument("action", choices=("build", "recall"))
+    annParser.add_argument("--lists", type=positiveInt, default=None, help="number of clusters, sqrt(images) by default")
+    annParser.add_argument("--nprobe", type=positiveInt, nargs="+", default=[1, 2, 4, 8, 16])
+    annParser.add_argument("--top-k", type=positiveInt, default=20)
+    annParser.add_argument("--queries", type=positiveInt, default=100, help="number of sampled query images")
+    annParser.set_defaults(run=annCommand)
+
+    args = parser.parse_args(argv)
+    if args.command == "query" and not args.images and not args.all:
+        parser.error("query needs at least one image or --all")
+    try:
+        retrieval.setDistanceEngine(args.engine)
+    except ValueError as error:
+        parser.error(str(error))
+
+    trace = timing.Trace(args.command)
+    with timing.activate(trace):
+        timing.profiled(lambda: args.run(args), args.profile, args.command)
+    trace.finish()
+    if args.trace:
+        print(trace.summary(), file=sys.stderr)
+        timing.writeTrace(trace, args.trace)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+import histograms as histogramEngine
+import timing
+
+
+# extraction
+#
+# Parallel feature extraction pipeline
+#
+# Splits a list of image paths into chunks and fans the JPEG decode and histogram work out over a
+# process pool with one worker per core
+# Finished chunks are streamed back as they complete and written straight into preallocated
+# intensity, color code and finer histogram matrices, with an optional progress callback after every chunk
+#
+# The pool uses the spawn start method so it is safe to start from a background thread of the GUI
+
+CHUNK_SIZE = 32
+
+
+# extractHistograms
+#
+# Decodes one image and returns its intensity and color code histograms, followed by the histogram of
+# every given Quantization computed from the same decoded pixels
+def extractHistograms(path, quantizations=()):
+    with timing.span("load"), Image.open(path) as img:
+        pixels = histogramEngine.toPixels(img)
+    with timing.span("histogram"):
+        return histogramEngine.intensityAndColorCodeHistograms(pixels) + tuple(
+            quantization.histogram(pixels) for quantization in quantizations)
+
+
+# histogramMatrices
+#
+# Allocates zeroed count matrices for the intensity, color code and finer histograms of count images
+def histogramMatrices(count, specs=()):
+    numBins = [histogramEngine.INTENSITY_BINS, histogramEngine.COLOR_CODE_BINS]
+    numBins += [histogramEngine.Quantization(spec).numBins for spec in specs]
+    return [np.zeros((count, bins), dtype=histogramEngine.COUNT_DTYPE) for bins in numBins]
+
+
+# extractChunk
+#
+# Extracts the histograms for a chunk of images inside a worker process
+# Returns them as one matrix per histogram so only one result is sent back per chunk
+# The finer histograms are given as Quantization spec strings, since those are cheap to send to the workers
+# With skipErrors images that cannot be read or decoded are left as rows of zeros instead of failing the chunk
+def extractChunk(paths, skipErrors=False, specs=()):
+    quantizations = [histogramEngine.Quantization(spec) for spec in specs]
+    matrices = histogramMatrices(len(paths), specs)
+    for i, path in enumerate(paths):
+        try:
+            histograms = extractHistograms(path, quantizations)
+        except (OSError, ValueError):
+            if not skipErrors:
+                raise
+            continue
+        for matrix, histogram in zip(matrices, histograms):
+            matrix[i] = histogram
+    return tuple(matrices)
+
+
+# defaultWorkers
+#
+# Number of worker processes to use, one per available core
+def defaultWorkers():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# extractFeatures
+#
+# Extracts the intensity and color code histograms of all given images, plus the finer histograms of every
+# Quantization spec in specs, all from a single decode of each image
+# Results are written into newly allocated matrices at the row of their image
+# progress is called as progress(done, total) from the calling thread after every finished chunk
+# Small jobs and workers=1 run in the calling process to skip the pool start up cost
+# With skipErrors undecodable images get all zero histograms instead of raising
+# Returns the tuple (intensity, colorCode, one matrix per spec)
+def extractFeatures(paths, workers=None, chunkSize=CHUNK_SIZE, progress=None, skipErrors=False, specs=()):
+    total = len(paths)
+    specs = tuple(specs)
+    matrices = histogramMatrices(total, specs)
+
+    workers = workers or defaultWorkers()
+    starts = range(0, total, chunkSize)
+
+    if workers == 1 or total <= chunkSize:
+        for start in starts:
+            stop = min(start + chunkSize, total)
+            for matrix, chunk in zip(matrices, extractChunk(paths[start:stop], skipErrors, specs)):
+                matrix[start:stop] = chunk
+            if progress:
+                progress(stop, total)
+        return tuple(matrices)
+
+    done = 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(starts)), mp_context=context) as executor:
+        futures = {executor.submit(extractChunk, list(paths[start:start + chunkSize]), skipErrors, specs): start
+                   for start in starts}
+        for future in as_completed(futures):
+            start = futures[future]
+            chunks = future.result()
+            stop = start + len(chunks[0])
+            for matrix, chunk in zip(matrices, chunks):
+                matrix[start:stop] = chunk
+
+            done += stop - start
+            if progress:
+                progress(done, total)
+
+    return tuple(matrices)
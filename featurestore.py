@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+import histograms as histogramEngine
+from extraction import extractFeatures
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff")
+
+
+# listImages
+#
+# Lists the image files in a folder in natural order, so 2.jpg comes before 10.jpg
+def listImages(imageFolder):
+    names = [name for name in os.listdir(imageFolder) if name.lower().endswith(IMAGE_EXTENSIONS)]
+    names.sort(key=lambda name: [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)])
+    return [os.path.join(imageFolder, name) for name in names]
+
+
+# class FeatureStore
+#
+# Persistent on-disk feature index for an image library
+#
+# Keeps a single N x 89 matrix of histogram counts, one row per image with the 25 intensity bins followed by
+# the 64 color code bins, saved as counts.npy so it can be memory mapped
+# The counts are stored as uint16 when every count fits and as uint32 otherwise, intensity and colorCode
+# are column views of that matrix and the combined histograms divided by the image size are computed from
+# it when asked for, so every feature is stored once in a compact type
+# A manifest.json next to it records the path, file size and modification time of the image behind each row,
+# and a fingerprint of the paths and counts that files derived from the index (the neighbour graph and the
+# approximate index) are saved with, so they can tell whether they are stale without hashing the counts again
+#
+# On startup the matrix is memory mapped instead of decoding every image again, and only the
+# images whose size or modification time changed since the last run are recomputed
+# Indexes saved as separate int64 intensity, colorCode and float64 features matrices are still read,
+# and are converted the next time the index is saved
+#
+# The store can also hold finer histograms, one count matrix per Quantization spec saved as fine-<spec>.npy
+# The manifest lists the specs of the index, so a store opened without asking for them still keeps them
+# up to date, and asking for a new spec decodes every image once more
+class FeatureStore:
+
+    MANIFEST = "manifest.json"
+    COUNTS = "counts"
+    FINE = "fine"
+    LEGACY_MATRICES = ("intensity", "colorCode", "features")
+
+    # init
+    #
+    # Sets the folder holding the index files and loads whatever index already exists there
+    # specs are the Quantization specs of the finer histograms the index should hold
+    def __init__(self, indexFolder, specs=()):
+        self.indexFolder = indexFolder
+        self.specs = [histogramEngine.Quantization(spec).spec for spec in specs]
+        self.paths = []
+        self.setCounts(np.zeros((0, histogramEngine.NUM_FEATURES), dtype=np.uint16))
+        self.fine = {}
+        self.manifest = {}
+        self.failed = []
+        self.savedFingerprint = None
+        self.load()
+
+    # setCounts
+    #
+    # Sets the count matrix and points the intensity and color code views at its columns
+    def setCounts(self, counts):
+        self.counts = counts
+        self.intensity = counts[:, :histogramEngine.INTENSITY_BINS]
+        self.colorCode = counts[:, histogramEngine.INTENSITY_BINS:]
+
+    # features
+    #
+    # Combined histograms divided by the image size, computed from the counts
+    @property
+    def features(self):
+        return histogramEngine.combinedFeature(self.intensity, self.colorCode)
+
+    # fingerprint
+    #
+    # Fingerprint of the index, read from the manifest (computed once for indexes saved without one)
+    @property
+    def fingerprint(self):
+        if self.savedFingerprint is None:
+            self.savedFingerprint = self.fingerprintOf(self.paths, self.counts)
+        return self.savedFingerprint
+
+    # fingerprintOf
+    #
+    # SHA-1 hash of image paths and their histogram counts
+    @staticmethod
+    def fingerprintOf(paths, counts):
+        digest = hashlib.sha1(json.dumps(paths).encode())
+        digest.update(np.ascontiguousarray(counts, dtype=histogramEngine.COUNT_DTYPE).tobytes())
+        return digest.hexdigest()
+
+    # finePath
+    #
+    # File the finer histograms of a spec are saved to
+    def finePath(self, spec):
+        return os.path.join(self.indexFolder, f"{self.FINE}-{spec}.npy")
+
+    # fileStamp
+    #
+    # Returns the size and modification time used to detect changed image files
+    @staticmethod
+    def fileStamp(path):
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    # load
+    #
+    # Memory maps the saved count matrices and reads the manifest
+    # Leaves the store empty if there is no index yet or it is incomplete, finer histograms that are
+    # missing or incomplete are left out and recomputed by the next update
+    def load(self):
+        manifestPath = os.path.join(self.indexFolder, self.MANIFEST)
+        if not os.path.exists(manifestPath):
+            return
+
+        try:
+            with open(manifestPath) as f:
+                manifest = json.load(f)
+            entries = manifest['entries']
+            countsPath = os.path.join(self.indexFolder, f"{self.COUNTS}.npy")
+            if os.path.exists(countsPath):
+                counts = np.load(countsPath, mmap_mode='r')
+            else:
+                counts = histogramEngine.compactCounts(np.concatenate(
+                    [np.load(os.path.join(self.indexFolder, f"{name}.npy"), mmap_mode='r')
+                     for name in self.LEGACY_MATRICES[:2]], axis=1))
+        except (OSError, ValueError, KeyError):
+            return
+
+        if counts.shape != (len(entries), histogramEngine.NUM_FEATURES):
+            return
+
+        self.setCounts(counts)
+        self.paths = [entry['path'] for entry in entries]
+        self.savedFingerprint = manifest.get('fingerprint')
+        self.manifest = {entry['path']: (i, entry['size'], entry['mtime']) for i, entry in enumerate(entries)}
+
+        self.specs += [spec for spec in manifest.get('specs', []) if spec not in self.specs]
+        self.fine = {}
+        for spec in self.specs:
+            try:
+                fine = np.load(self.finePath(spec), mmap_mode='r')
+            except (OSError, ValueError):
+                continue
+            if fine.shape == (len(entries), histogramEngine.Quantization(spec).numBins):
+                self.fine[spec] = fine
+
+    # save
+    #
+    # Writes the count matrices and the manifest to the index folder
+    # Every file is written to a temporary name first and then renamed, so an interrupted save
+    # never leaves a half written index behind
+    def save(self, stamps):
+        os.makedirs(self.indexFolder, exist_ok=True)
+
+        matrices = [(os.path.join(self.indexFolder, f"{self.COUNTS}.npy"), self.counts)]
+        matrices += [(self.finePath(spec), self.fine[spec]) for spec in self.specs]
+        for path, counts in matrices:
+            with open(path + ".tmp", 'wb') as f:
+                np.save(f, np.ascontiguousarray(histogramEngine.compactCounts(counts)))
+            os.replace(path + ".tmp", path)
+
+        entries = [{'path': path, **stamp} for path, stamp in zip(self.paths, stamps)]
+        manifestPath = os.path.join(self.indexFolder, self.MANIFEST)
+        with open(manifestPath + ".tmp", 'w') as f:
+            json.dump({'entries': entries, 'specs': self.specs,
+                       'fingerprint': self.fingerprintOf(self.paths, self.counts)}, f)
+        os.replace(manifestPath + ".tmp", manifestPath)
+
+        for name in self.LEGACY_MATRICES:
+            legacyPath = os.path.join(self.indexFolder, f"{name}.npy")
+            if os.path.exists(legacyPath):
+                os.remove(legacyPath)
+
+    # update
+    #
+    # Brings the index in line with the given list of image paths, in that order
+    # Rows of unchanged images are copied from the existing index, changed and new images are decoded
+    # in parallel by the extraction pipeline, which reports progress(done, total) as chunks finish
+    # Every image is decoded again when the index is missing the finer histograms of one of its specs
+    # With skipErrors images that cannot be decoded are left out of the index and listed in failed, without
+    # a manifest entry they are tried again by the next update
+    # If nothing changed the memory mapped index is kept as is and nothing is written
+    # Returns the number of images that had to be decoded
+    def update(self, imagePaths, progress=None, workers=None, skipErrors=False):
+        stamps = [self.fileStamp(path) for path in imagePaths]
+        self.failed = []
+
+        complete = all(spec in self.fine for spec in self.specs)
+        reused = []
+        changed = []
+        for row, (path, stamp) in enumerate(zip(imagePaths, stamps)):
+            entry = self.manifest.get(path)
+            if complete and entry is not None and entry[1:] == (stamp['size'], stamp['mtime']):
+                reused.append((row, entry[0]))
+            else:
+                changed.append(row)
+
+        unchanged = not changed and [old for _, old in reused] == list(range(len(self.paths)))
+        if unchanged:
+            return 0
+
+        counts = np.zeros((len(imagePaths), histogramEngine.NUM_FEATURES), dtype=histogramEngine.COUNT_DTYPE)
+        fine = {spec: np.zeros((len(imagePaths), histogramEngine.Quantization(spec).numBins),
+                               dtype=histogramEngine.COUNT_DTYPE) for spec in self.specs}
+        if reused:
+            rows, oldRows = map(list, zip(*reused))
+            counts[rows] = self.counts[oldRows]
+            for spec in self.specs:
+                fine[spec][rows] = self.fine[spec][oldRows]
+
+        failedRows = []
+        if changed:
+            changedIntensity, changedColorCode, *changedFine = extractFeatures(
+                [imagePaths[row] for row in changed], workers=workers, progress=progress, specs=self.specs,
+                skipErrors=skipErrors)
+            counts[changed, :histogramEngine.INTENSITY_BINS] = changedIntensity
+            counts[changed, histogramEngine.INTENSITY_BINS:] = changedColorCode
+            for spec, changedCounts in zip(self.specs, changedFine):
+                fine[spec][changed] = changedCounts
+            failedRows = [row for row, pixels in zip(changed, np.sum(changedIntensity, axis=1)) if pixels == 0]
+
+        # Undecodable images got histograms without any pixels, when they are the only change the index is kept
+        if failedRows:
+            self.failed = [imagePaths[row] for row in failedRows]
+            if len(failedRows) == len(changed) and [old for _, old in reused] == list(range(len(self.paths))):
+                return len(changed)
+            keep = np.setdiff1d(np.arange(len(imagePaths)), failedRows)
+            counts = counts[keep]
+            fine = {spec: fineCounts[keep] for spec, fineCounts in fine.items()}
+            imagePaths = [imagePaths[row] for row in keep]
+            stamps = [stamps[row] for row in keep]
+
+        self.setCounts(counts)
+        self.fine = fine
+        self.paths = list(imagePaths)
+        self.save(stamps)
+        self.load()
+        return len(changed)
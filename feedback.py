@@ -0,0 +1,152 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+import histograms as histogramEngine
+
+
+# feedback
+#
+# Multi-round relevance feedback sessions for the both method
+#
+# A FeedbackSession follows one user refining one query over several rounds, every round records the images
+# marked relevant and non relevant and the session keeps
+#     the relevant and non relevant sets of all rounds, a later judgement of an image replaces an earlier one
+#     the feature weights derived from every image judged relevant so far, as for a single relevant set
+#     the query point, moved after each round toward the relevant and away from the non relevant images of
+#     that round with Rocchio's formula  q' = alpha * q + beta * mean(relevant) - gamma * mean(non relevant)
+# With beta and gamma set to 0 the query point stays put and the session only reweights the features
+#
+# FeedbackSessions holds the sessions of many users on one image index and scores any number of them in a
+# single pass over the index, each with its own query point and weights
+# Sessions refer to images by their row in the index, so they are meant for an index that does not change
+
+
+# class FeedbackSession
+#
+# State of one relevance feedback session
+class FeedbackSession:
+
+    # init
+    #
+    # Starts a session from the combined histogram of the query (divided by the image size, as the rows of
+    # ImageIndex.featuresOf), exclude is the row of the query image left out of the results if it is indexed
+    # alpha, beta and gamma are the Rocchio weights of the query point, the relevant and the non relevant images
+    def __init__(self, queryFeatures, exclude=None, alpha=1.0, beta=0.75, gamma=0.15):
+        self.queryFeatures = np.asarray(queryFeatures, dtype=float)
+        self.queryPoint = self.queryFeatures
+        self.exclude = exclude
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.rounds = []
+        self.relevant = set()
+        self.nonRelevant = set()
+        self.weights = None
+        self.weightsKey = None
+
+    # addRound
+    #
+    # Records the relevant and non relevant rows of one round and moves the query point
+    # An image given as both relevant and non relevant counts as relevant
+    def addRound(self, imageIndex, relevant=(), nonRelevant=()):
+        relevant = sorted(set(relevant))
+        nonRelevant = sorted(set(nonRelevant) - set(relevant))
+        self.rounds.append((relevant, nonRelevant))
+        self.relevant = (self.relevant - set(nonRelevant)) | set(relevant)
+        self.nonRelevant = (self.nonRelevant - set(relevant)) | set(nonRelevant)
+
+        queryPoint = self.alpha * self.queryPoint
+        if relevant and self.beta:
+            queryPoint = queryPoint + self.beta * np.mean(imageIndex.featuresOf(relevant), axis=0)
+        if nonRelevant and self.gamma:
+            queryPoint = queryPoint - self.gamma * np.mean(imageIndex.featuresOf(nonRelevant), axis=0)
+        self.queryPoint = self.histogramScale(queryPoint)
+
+    # histogramScale
+    #
+    # Clips a moved query point at zero and scales its intensity and color code parts back to a sum of one,
+    # so it stays comparable to the rows of the index
+    @staticmethod
+    def histogramScale(queryPoint):
+        queryPoint = np.maximum(queryPoint, 0)
+        for part in (slice(None, histogramEngine.INTENSITY_BINS), slice(histogramEngine.INTENSITY_BINS, None)):
+            total = np.sum(queryPoint[part])
+            if total > 0:
+                queryPoint[part] /= total
+        return queryPoint
+
+    # currentWeights
+    #
+    # Weights applied to |x - q| for this session, derived from every image judged relevant so far
+    # Only recomputed after a new round or when the index changes
+    def currentWeights(self, imageIndex):
+        key = (imageIndex.version, len(self.rounds))
+        if self.weightsKey != key:
+            self.weights = imageIndex.relevanceWeights(sorted(self.relevant))
+            self.weightsKey = key
+        return self.weights
+
+
+# class FeedbackSessions
+#
+# Feedback sessions of many users on one image index
+#
+# At most maxSessions sessions are kept, starting a session beyond that drops the least recently used one
+# The sessions can be used from several threads
+class FeedbackSessions:
+
+    # init
+    #
+    # Takes the image index the sessions query and the largest number of sessions kept
+    def __init__(self, imageIndex, maxSessions=1024):
+        self.imageIndex = imageIndex
+        self.maxSessions = maxSessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    # len
+    #
+    # Number of open sessions
+    def __len__(self):
+        return len(self.sessions)
+
+    # start
+    #
+    # Opens a session for a query (see FeedbackSession) and returns its id
+    def start(self, queryFeatures, exclude=None, **rocchio):
+        sessionId = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[sessionId] = FeedbackSession(queryFeatures, exclude, **rocchio)
+            while len(self.sessions) > self.maxSessions:
+                self.sessions.popitem(last=False)
+        return sessionId
+
+    # get
+    #
+    # Returns a session by its id, raising KeyError if it does not exist or was dropped
+    def get(self, sessionId):
+        with self.lock:
+            session = self.sessions[sessionId]
+            self.sessions.move_to_end(sessionId)
+            return session
+
+    # addRound
+    #
+    # Adds a round of relevant and non relevant rows to a session and returns the number of rounds so far
+    def addRound(self, session, relevant=(), nonRelevant=()):
+        with self.lock:
+            session.addRound(self.imageIndex, relevant, nonRelevant)
+            return len(session.rounds)
+
+    # distances
+    #
+    # Weighted Manhattan distance of every image to the query point of each session, one row per session
+    # The query points and weights of all sessions are stacked so they are scored in a single pass
+    def distances(self, sessions):
+        with self.lock:
+            queryPoints = np.stack([session.queryPoint for session in sessions])
+            weights = np.stack([session.currentWeights(self.imageIndex) for session in sessions])
+        return self.imageIndex.weightedDistances(queryPoints, weights)
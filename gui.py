@@ -1,7 +1,20 @@
+import bisect
 import os
+import threading
+import time
 import tkinter as tk
-from PIL import Image, ImageTk
-import numpy as np
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import ttk
+from PIL import ImageTk
+from featurestore import FeatureStore, listImages
+from thumbnails import ThumbnailCache
+import retrieval
+import timing
+from extraction import extractHistograms
+from imageindex import ImageIndex
+from neighbours import GraphRanking, NeighbourGraph
+from watcher import FolderWatcher
 
 
 # class ImageViewer
@@ -33,34 +46,96 @@ class ImageViewer:
     #The constructor, sets up the main window title, dimensions, and variables
     #Defines the image folder, number of images per page, total images, and the current page
     #Initializes the selected image name as none
+    # traceFile is an optional JSON lines file every query's timing breakdown is appended to,
+    # and queries are run under cProfile with the statistics saved in profileFolder when one is given
+    # With watch the image folder is watched for new, changed and deleted images once indexing is done
     # 
-    def __init__(self, root):
+    def __init__(self, root, traceFile=None, profileFolder=None, watch=False):
         self.root = root
         self.root.title("Image Browser")
         self.root.geometry("1000x600")
         self.imageFolder = "images"
-        self.imagesPerPage = 20
-        self.totalImages = 100
-        self.currentPage = 0
+        self.indexFolder = "index"
+        self.thumbnailCacheBytes = 64 * 1024 * 1024  # Memory budget for cached thumbnails
+        self.thumbnailSize = (197, 143)  # Fixed size for consistency
+        self.selectedImageSize = (500, 470)
+        # The grid is a virtual list of cells scrolled by scrollOffset pixels, only the rows in view
+        # plus overscanRows above and below are backed by widgets
+        self.gridColumns = 4
+        self.cellSize = (210, 210)  # Cell frame plus padding
+        self.overscanRows = 1
+        self.scrollOffset = 0
+        self.scrollUnit = self.cellSize[1] // 2
+        self.viewportHeight = 600  # Until the canvas reports its size
         self.selectedImageName = None
+        self.selectedImageIndex = None
         self.relevanceChecked = tk.BooleanVar()  # Variable to hold the state of the Checkbutton
-        self.relevanceState = {}
         self.relevantIndices = []
-        
-
-        # Initialized a list to store all the images from the image files, with each image named based on its order number
-        self.imageList = []
-        for i in range(self.totalImages):
-            imagePath = os.path.join(self.imageFolder, f"{i + 1}.jpg")
-            img = Image.open(imagePath)
-            self.imageList.append(img)
 
-        self.allHistograms = self.calculateHistograms()
-        self.sortedImages = list(range(self.totalImages))
+        # Queries and thumbnails run on background worker threads, their results are handed back to the
+        # Tk main loop, which checks on them every pollInterval milliseconds
+        # Queries run one at a time and a new query supersedes any query still waiting or running
+        self.queryPool = ThreadPoolExecutor(max_workers=1)
+        self.thumbnailPool = ThreadPoolExecutor(max_workers=4)
+        self.pollInterval = 16
+        self.pendingTasks = []
+        self.pollScheduled = False
+        self.queryFuture = None
+        self.queryGeneration = 0
+        self.selectedGeneration = 0
+
+        # The query worker reads the image index while watch mode and refreshes change it on the Tk main loop,
+        # both sides hold indexLock while they use it, and a query of an index changed since its click is dropped
+        self.indexLock = threading.Lock()
+
+        # Timing breakdown of the latest query, shown in the status area when timings are enabled
+        self.traceFile = traceFile
+        self.profileFolder = profileFolder
+        self.showTimings = tk.BooleanVar()
+        self.lastTrace = None
+
+        # Watch mode streams images landing in the folder into the index, the results of the watcher are
+        # applied on the Tk main loop every watchPollInterval milliseconds, at most watchBatch at a time
+        self.watchFolder = tk.BooleanVar(value=watch)
+        self.folderWatcher = None
+        self.watchPollInterval = 250
+        self.watchBatch = 64
+
+
+        # Initialized a list to store the paths of all the image files in the folder, in natural order
+        # Images are only opened when their thumbnail is needed, and thumbnails are kept in a bounded cache
+        self.imagePaths = listImages(self.imageFolder)
+        self.totalImages = len(self.imagePaths)
+        self.thumbnailCache = ThumbnailCache(
+            self.thumbnailCacheBytes, os.path.join(self.indexFolder, "thumbnails"))
+
+        # Load the saved feature index, only images changed since the last run are decoded again
+        # Indexing runs on a background thread so the window stays responsive while it works
+        self.featureStore = FeatureStore(self.indexFolder)
+        self.indexProgress = (0, self.totalImages)
+        self.indexReady = False
+        self.indexError = None
+        self.indexThread = threading.Thread(target=self.buildIndex, daemon=True)
+        self.imageIndex = None
+
+        # Neighbour graph built by python cli.py neighbours build, queries without relevance feedback are looked up
+        # in it while it matches the index
+        self.neighbourGraph = None
+
+        self.sortedImages = range(self.totalImages)
 
         self.canvas = tk.Canvas(self.root)
         self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
+        # The scrollbar drives scrollOffset, the canvas itself never scrolls so its size does not
+        # depend on the number of images
+        self.scrollbar = tk.Scrollbar(self.root, orient=tk.VERTICAL, command=self.onScroll)
+        self.scrollbar.pack(side=tk.LEFT, fill=tk.Y)
+        self.canvas.bind("<Configure>", self.onCanvasResize)
+        self.root.bind_all("<MouseWheel>", self.onMouseWheel)
+        self.root.bind_all("<Button-4>", self.onMouseWheel)
+        self.root.bind_all("<Button-5>", self.onMouseWheel)
+
         # Frame for the display of the selected image and its label
         self.selectedImageBox = tk.Frame(
             self.root, width=200, height=200, highlightbackground="white", highlightcolor="white", highlightthickness=2)
@@ -80,9 +155,17 @@ class ImageViewer:
         self.navButton.pack(side=tk.LEFT, padx=20)
 
         self.pageNumber = tk.Label(
-            self.navButton, text=f"Page {self.currentPage + 1} / 5", font=("Arial", 12))
+            self.navButton, text="", font=("Arial", 12))
         self.pageNumber.pack(pady=5)
 
+        # Label showing the progress of feature indexing
+        self.statusLabel = tk.Label(self.navButton, text="", font=("Arial", 10))
+        self.statusLabel.pack(pady=5)
+
+        # Progress indicator that runs while queries or thumbnails are being worked on in the background
+        self.progressBar = ttk.Progressbar(self.navButton, mode="indeterminate", length=120)
+        self.progressBar.pack(pady=5)
+
         self.prevButton = tk.Button(
             self.navButton, text="Up", command=self.upper, width=15, height=2)
         self.prevButton.pack(pady=5)
@@ -110,13 +193,18 @@ class ImageViewer:
         self.retrieveIntensityButton.pack(pady=5)
 
         self.closeButton = tk.Button(
-            self.retrieveButton, text="Close", command=self.root.quit, width=28, height=2)
+            self.retrieveButton, text="Close", command=self.close, width=28, height=2)
         self.closeButton.pack(pady=5)
 
         self.resetButton = tk.Button(
             self.retrieveButton, text="Reset", command=self.resetOrder, width=28, height=2)
         self.resetButton.pack(pady=5)
 
+        # Rescans the image folder for added and deleted images
+        self.refreshButton = tk.Button(
+            self.retrieveButton, text="Refresh Folder", command=self.refreshFolder, width=28, height=2)
+        self.refreshButton.pack(pady=5)
+
         # relevance check button
         # Enable or disable relevance button
         self.relevanceToggle = tk.Checkbutton(
@@ -124,186 +212,453 @@ class ImageViewer:
             command=self.onRelevanceToggle)
         self.relevanceToggle.pack(pady=5)
 
-        #relevant checkbox for each image
-        self.relevanceState = {i: tk.BooleanVar() for i in range(self.totalImages)}
+        # Shows where the time of the latest query went in the status area
+        self.timingsToggle = tk.Checkbutton(
+            self.navButton, text="Timings", variable=self.showTimings, onvalue=True, offvalue=False,
+            command=self.onTimingsToggle)
+        self.timingsToggle.pack(pady=5)
 
+        # Picks up images landing in the folder without a restart
+        self.watchToggle = tk.Checkbutton(
+            self.navButton, text="Watch Folder", variable=self.watchFolder, onvalue=True, offvalue=False,
+            command=self.onWatchToggle)
+        self.watchToggle.pack(pady=5)
 
         # Displaying all images in a grid
+        self.gridCells = []
         self.displayImages()
 
-    # displayImages
+        # Start indexing the image features
+        self.indexThread.start()
+        self.pollIndex()
+
+    # buildIndex
     #
-    # Displays a grid of images
-    # Clears the previous grid, retrieves the images from a sorted list based on the current order
-    # and arranges them in a grid
-    # Binds click to each image, allowing the user to select individual images
-    # Updates the page number based on the current order
-    def displayImages(self):
-        # Clear the existing grid before creating a new one
-        for widget in self.canvas.winfo_children():
-            widget.destroy()
-
-        # Create a new grid whenever display is called
-        self.grid = tk.Frame(self.canvas)
-        self.canvas.create_window(
-            (0, 0), window=self.grid, anchor="nw")
-
-        # Prepare a new list of images to be displayed
-        imagesToDisplay = []
-        for i in self.sortedImages:
-            imagesToDisplay.append(self.imageList[i])
-
-        startIndex = self.currentPage * self.imagesPerPage
-        endIndex = min(startIndex + self.imagesPerPage, len(imagesToDisplay))
-        columns = 4
-
-        # Go through all the images to display on the current page
-        for i, imgIndex in enumerate(range(startIndex, endIndex)):
-            img = imagesToDisplay[imgIndex]
-            imgResized = img.resize((197, 143))  # Fixed size for consistency
-            imgTk = ImageTk.PhotoImage(imgResized)
+    # Runs on the background indexing thread
+    # Updates the feature index, decoding changed images in parallel and recording the progress
+    # Images that cannot be decoded are left out of the index, any other failure is kept for pollIndex to show
+    # Loads the neighbour graph if one was built for this index
+    def buildIndex(self):
+        try:
+            self.featureStore.update(self.imagePaths, progress=self.onIndexProgress, skipErrors=True)
+            self.neighbourGraph = NeighbourGraph.load(
+                os.path.join(self.indexFolder, NeighbourGraph.FILE), self.featureStore.fingerprint)
+        except Exception as error:
+            self.indexError = error
+
+    # onIndexProgress
+    #
+    # Records how many images have been indexed so far, called from the indexing thread
+    def onIndexProgress(self, done, total):
+        self.indexProgress = (done, total)
 
-            # Create the grid for the current image with fixed size to avoid resizing
-            imgFrame = tk.Frame(self.grid, width=200, height=200)
-            imgFrame.grid_propagate(False)  # Prevent frame resizing based on contents
-            imgFrame.grid(row=i // columns, column=i % columns, padx=5, pady=5)
+    # pollIndex
+    #
+    # Checks on the indexing thread from the Tk main loop and shows its progress
+    # Once indexing is finished the histograms are loaded and retrieval is enabled
+    # The grid only keeps the images that made it into the index, if indexing failed retrieval stays disabled
+    def pollIndex(self):
+        if self.indexThread.is_alive():
+            done, total = self.indexProgress
+            self.statusLabel.config(text=f"Indexing {done} / {total}")
+            self.root.after(100, self.pollIndex)
+            return
+        if self.indexError is not None:
+            self.statusLabel.config(text=f"Indexing failed: {self.indexError}")
+            return
 
-            # Label for displaying the image
-            label = tk.Label(imgFrame, image=imgTk)
-            label.image = imgTk
-            label.pack()
-            
-            imageName = f"{self.sortedImages[imgIndex] + 1}.jpg"
-            nameLabel = tk.Label(imgFrame, text=imageName, wraplength=200)
-
-            # If relevanceChecked is enabled, create a combined label and checkbox text
-            if self.relevanceChecked.get():
-                combinedText = f"Relevant    {imageName}"
-                relevanceCheck = tk.Checkbutton(
-                    imgFrame, text=combinedText,
-                    variable=self.relevanceState[self.sortedImages[imgIndex]],
-                    command=self.updateRelevance
-                )
-                relevanceCheck.pack(padx=5)
+        store = self.featureStore
+        self.imageIndex = ImageIndex(store.paths, store.intensity, store.colorCode)
+        self.imagePaths = self.imageIndex.paths
+        self.imageStamps = {path: entry[1:] for path, entry in store.manifest.items()}
+        self.failedStamps = {}
+        self.indexReady = True
+        if self.totalImages != len(self.imageIndex):
+            # Rows picked before indexing finished no longer point at the same images
+            self.totalImages = len(self.imageIndex)
+            self.selectedImageIndex = None
+            self.selectedImageName = None
+            self.relevantIndices = []
+            self.resetOrder()
+        skipped = f", {len(store.failed)} could not be decoded" if store.failed else ""
+        self.statusLabel.config(text=f"Indexed {self.totalImages} images{skipped}")
+        if self.watchFolder.get():
+            self.startWatching()
+
+    # runInBackground
+    #
+    # Runs work() on a worker pool and calls onDone(result) on the Tk main loop once it is finished
+    # Returns the future so the task can be cancelled
+    def runInBackground(self, pool, work, onDone):
+        future = pool.submit(work)
+        self.pendingTasks.append((future, onDone))
+        self.progressBar.start(10)
+        if not self.pollScheduled:
+            self.pollScheduled = True
+            self.root.after(self.pollInterval, self.pollTasks)
+        return future
+
+    # pollTasks
+    #
+    # Hands the results of finished background tasks to their callbacks on the Tk main loop
+    # A task or callback that fails is reported and dropped, the other tasks carry on
+    # Keeps polling while tasks are pending and stops the progress indicator once all are done
+    def pollTasks(self):
+        tasks, self.pendingTasks = self.pendingTasks, []
+        try:
+            for future, onDone in tasks:
+                if not future.done():
+                    self.pendingTasks.append((future, onDone))
+                    continue
+                if future.cancelled():
+                    continue
+
+                error = future.exception()
+                if error is None:
+                    try:
+                        onDone(future.result())
+                    except Exception as callbackError:
+                        error = callbackError
+                if error is not None:
+                    self.reportError(error)
+        finally:
+            if self.pendingTasks:
+                self.root.after(self.pollInterval, self.pollTasks)
             else:
-                # If relevanceChecked is not true, just display the image name label
-                nameLabel = tk.Label(imgFrame, text=imageName, wraplength=200)
-                nameLabel.pack()
-
-            # Bind click to each image
-            label.bind("<Button-1>", lambda e,
-                    index=self.sortedImages[imgIndex]: self.displaySelectedImage(index))
-
-        # Update the page number label
-        numPages = (self.totalImages + self.imagesPerPage - 1) // self.imagesPerPage
-        self.pageNumber.config(
-            text=f"Page {self.currentPage + 1} / {numPages}")
-
+                self.pollScheduled = False
+                self.progressBar.stop()
 
+    # reportError
+    #
+    # Shows the error of a failed background task in the status area and prints its traceback
+    def reportError(self, error):
+        traceback.print_exception(type(error), error, error.__traceback__)
+        self.statusLabel.config(text=f"Error: {error}")
 
-    # displaySelectedImage
+    # startQuery
     #
-    # Displays the selected image
-    # Resizes the selected image to fit the display area
-    # Updates the name of current selected image to reflect the new one
-    def displaySelectedImage(self, imgIndex):
-        img = self.imageList[imgIndex]
-        imgResized = img.resize((500, 470))
-        imgTk = ImageTk.PhotoImage(imgResized)
+    # Computes the distances of a query on the query worker and shows the ranking once it is ready
+    # Any earlier query is cancelled, and results of superseded queries or of an index that has
+    # changed in the meantime are dropped
+    # The query is traced from the click until its first screen is rendered, name labels the trace
+    # Queries of a method without relevance feedback pass its name as method, they are looked up in the
+    # neighbour graph when there is one and only scan the library when scrolled past its neighbours
+    def startQuery(self, computeDistances, name, method=None):
+        self.cancelQuery()
+        generation = self.queryGeneration
+        version = self.imageIndex.version
+        selectedImageIndex = self.selectedImageIndex
+        graph = self.neighbourGraph if method else None
+        trace = timing.Trace(f"{name} {self.selectedImageName}")
+
+        def rank():
+            ranking = graph.ranking(self.imageIndex, method, selectedImageIndex) if graph is not None else None
+            return ranking or retrieval.Ranking(computeDistances(), selectedImageIndex, len(self.gridCells))
+
+        def work():
+            trace.add("queue", time.perf_counter() - trace.start)
+            with self.indexLock:
+                if version != self.imageIndex.version:
+                    return None
+                with timing.activate(trace):
+                    return timing.profiled(rank, self.profileFolder, "query")
+
+        def onDone(ranking):
+            if ranking is not None and generation == self.queryGeneration and version == self.imageIndex.version:
+                with timing.activate(trace):
+                    self.showRanking(ranking)
+                self.reportTrace(trace.finish())
+
+        self.queryFuture = self.runInBackground(self.queryPool, work, onDone)
+
+    # completeRanking
+    #
+    # Ranks the images past the neighbours of a graph ranking on the query worker, at least count of them,
+    # and redraws the grid once they are ready, so scrolling past the graph never scans the library on the
+    # Tk main loop
+    # Does nothing while a query or an earlier completion is still running, the ranking is dropped if it is
+    # no longer on screen, which is also the case once images have been removed from the index
+    def completeRanking(self, ranking, count):
+        if self.queryFuture is not None and not self.queryFuture.done():
+            return
 
-        # Label selected image
-        self.selectedImageLabel.configure(image=imgTk)
-        self.selectedImageLabel.image = imgTk
+        def work():
+            with self.indexLock:
+                if self.sortedImages is not ranking:
+                    return None
+                fullRanking = ranking.full()
+                fullRanking.extend(count)
+                return fullRanking
 
-        # Set the name of the currently selected image
-        self.selectedImageName = os.path.basename(
-            os.path.join(self.imageFolder, f"{imgIndex + 1}.jpg"))
+        def onDone(fullRanking):
+            if fullRanking is not None and self.sortedImages is ranking:
+                self.displayImages()
 
-    # Upper
-    #
-    # Navigates to the upper page of images
-    # Calls displayImages() to display theupper grid
-    def upper(self):
-        if self.currentPage > 0:
-            self.currentPage -= 1
-            self.displayImages()
+        self.queryFuture = self.runInBackground(self.queryPool, work, onDone)
 
-    # Under
+    # reportTrace
     #
-    # Navigates to the page of images below
-    # Calls displayImages() to display the grid below
-    def under(self):
-        if (self.currentPage + 1) * self.imagesPerPage < len(self.sortedImages):
-            self.currentPage += 1
-            self.displayImages()
+    # Shows the timing breakdown of a finished action in the status area when timings are enabled
+    # and appends it to the trace file if there is one
+    def reportTrace(self, trace):
+        self.lastTrace = trace
+        if self.showTimings.get():
+            self.statusLabel.config(text=trace.summary())
+        if self.traceFile:
+            timing.writeTrace(trace, self.traceFile)
+
+    # onTimingsToggle
+    #
+    # Shows the breakdown of the latest query when timings are enabled, the image count otherwise
+    def onTimingsToggle(self):
+        if self.showTimings.get() and self.lastTrace is not None:
+            self.statusLabel.config(text=self.lastTrace.summary())
+        elif self.indexReady:
+            self.statusLabel.config(text=f"Indexed {self.totalImages} images")
+
+    # cancelQuery
+    #
+    # Cancels the current query if it has not finished yet
+    def cancelQuery(self):
+        self.queryGeneration += 1
+        if self.queryFuture is not None:
+            self.queryFuture.cancel()
+            self.queryFuture = None
+
+    # close
+    #
+    # Stops the background workers and closes the application
+    def close(self):
+        self.cancelQuery()
+        self.stopWatching()
+        self.queryPool.shutdown(wait=False, cancel_futures=True)
+        self.thumbnailPool.shutdown(wait=False, cancel_futures=True)
+        self.root.quit()
+
+    # createCell
+    #
+    # Creates one reusable grid cell as a window item of the canvas
+    # Each cell is a dictionary holding its widgets and the image it currently shows
+    # The click binding and checkbox command look up the cell's current image, so they never need rebinding
+    def createCell(self):
+        # Create the grid for the image with fixed size to avoid resizing
+        imgFrame = tk.Frame(self.canvas, width=200, height=200)
+        imgFrame.grid_propagate(False)  # Prevent frame resizing based on contents
+        windowId = self.canvas.create_window((0, 0), window=imgFrame, anchor="nw", state="hidden")
+
+        # Label for displaying the image, name label and relevance checkbox
+        label = tk.Label(imgFrame)
+        label.pack()
+        nameLabel = tk.Label(imgFrame, wraplength=200)
+        relevanceVar = tk.BooleanVar()
+        relevanceCheck = tk.Checkbutton(imgFrame, variable=relevanceVar)
+
+        cell = {'frame': imgFrame, 'window': windowId, 'label': label, 'nameLabel': nameLabel,
+                'relevanceCheck': relevanceCheck, 'relevanceVar': relevanceVar, 'imageIndex': None,
+                'imagePath': None, 'relevance': None, 'thumbnailFuture': None}
+        relevanceCheck.config(command=lambda: self.toggleRelevance(cell['imageIndex'], relevanceVar.get()))
+
+        # Bind click to each image
+        label.bind("<Button-1>", lambda e: self.displaySelectedImage(cell['imageIndex']))
+        return cell
+
+    # visibleRows
+    #
+    # Number of whole grid rows that fit in the canvas
+    def visibleRows(self):
+        return max(1, self.viewportHeight // self.cellSize[1])
 
-    # calculateHistograms
+    # displayImages
     #
-    # Computes and stores histograms for all images in a dictionary
-    # The dictionary contains two lists for colorCode and intensity histograms
-    # Accesses the dictionary by image labels
-    def calculateHistograms(self):
-        histograms = {}
+    # Displays the part of the image grid that is scrolled into view
+    # Only the rows in the viewport plus overscanRows above and below are backed by cells, so the number
+    # of widgets and thumbnails does not depend on how many images there are
+    # Cell i always shows a position congruent to i modulo the number of cells, so scrolling keeps the
+    # cells that stay in view and only refills the rows that come into view
+    # Thumbnails that are not cached yet are generated in the background and filled in when ready
+    # Updates the scrollbar and the label with the range of images in view
+    def displayImages(self):
+        with timing.span("render"):
+            numImages = len(self.sortedImages)
+            columns = self.gridColumns
+            cellWidth, cellHeight = self.cellSize
+            numRows = (numImages + columns - 1) // columns
+            maxOffset = max(0, numRows * cellHeight - self.viewportHeight)
+            self.scrollOffset = min(max(0, self.scrollOffset), maxOffset)
+
+            # Grow the pool of cells when the viewport got taller
+            poolRows = -(-self.viewportHeight // cellHeight) + 1 + 2 * self.overscanRows
+            while len(self.gridCells) < poolRows * columns:
+                self.gridCells.append(self.createCell())
+            poolSize = len(self.gridCells)
+
+            # Only the images of the materialized rows are taken from the ranking, so only those need to be ranked
+            # Ranks past the neighbours of a graph ranking are left empty until the query worker has computed them
+            firstRow = max(0, self.scrollOffset // cellHeight - self.overscanRows)
+            startIndex = firstRow * columns
+            endIndex = min(startIndex + poolSize, numImages)
+            if isinstance(self.sortedImages, GraphRanking) and endIndex > self.sortedImages.rankedCount():
+                self.completeRanking(self.sortedImages, endIndex)
+                endIndex = max(startIndex, min(endIndex, self.sortedImages.rankedCount()))
+            images = self.sortedImages[startIndex:endIndex] if endIndex > startIndex else []
+
+            for position in range(startIndex, startIndex + poolSize):
+                cell = self.gridCells[position % poolSize]
+                if position < endIndex:
+                    self.updateCell(cell, images[position - startIndex])
+                    self.canvas.coords(cell['window'], 5 + (position % columns) * cellWidth,
+                                       5 + (position // columns) * cellHeight - self.scrollOffset)
+                elif cell['imageIndex'] is not None:
+                    self.canvas.itemconfigure(cell['window'], state="hidden")
+                    self.cancelThumbnail(cell)
+                    cell.update(imageIndex=None, imagePath=None, relevance=None)
+
+            # Update the scrollbar and the label with the images in view
+            contentHeight = max(1, numRows * cellHeight)
+            self.scrollbar.set(self.scrollOffset / contentHeight,
+                               min(1.0, (self.scrollOffset + self.viewportHeight) / contentHeight))
+            firstVisible = min(numImages, self.scrollOffset // cellHeight * columns + 1)
+            lastVisible = min(numImages, -(-(self.scrollOffset + self.viewportHeight) // cellHeight) * columns)
+            self.pageNumber.config(text=f"Images {firstVisible}-{lastVisible} / {numImages}")
+
+    # updateCell
+    #
+    # Shows an image in a grid cell, changing only what differs from what the cell already shows
+    def updateCell(self, cell, imageIndex):
+        imagePath = self.imagePaths[imageIndex]
+        relevance = self.relevanceChecked.get()
+        if cell['imageIndex'] is None:
+            self.canvas.itemconfigure(cell['window'], state="normal")
+
+        if cell['imagePath'] != imagePath:
+            self.cancelThumbnail(cell)
+            cell['imagePath'] = imagePath
+            cell['label'].configure(image="")
+            cell['label'].image = None
+            cell['thumbnailFuture'] = self.showThumbnail(cell['label'], imagePath, self.thumbnailSize,
+                                                         lambda: cell['imagePath'] == imagePath)
+        elif cell['imageIndex'] == imageIndex and cell['relevance'] == relevance:
+            return
 
-        # Go through the list of images
-        for i in range(self.totalImages):
-            img = self.imageList[i]
+        cell['imageIndex'] = imageIndex
+        cell['relevance'] = relevance
+        imageName = os.path.basename(imagePath)
+
+        # If relevanceChecked is enabled, show a combined label and checkbox text
+        if relevance:
+            cell['nameLabel'].pack_forget()
+            cell['relevanceVar'].set(self.isRelevant(imageIndex))
+            cell['relevanceCheck'].config(text=f"Relevant    {imageName}")
+            cell['relevanceCheck'].pack(padx=5)
+        else:
+            # If relevanceChecked is not true, just display the image name label
+            cell['relevanceCheck'].pack_forget()
+            cell['nameLabel'].config(text=imageName)
+            cell['nameLabel'].pack()
 
-            # Called upon colorCodeHistorgram
-            histograms[f"{i + 1}.jpg"] = {
-                'colorCode': self.colorCodeHistogram(img),
-                'intensity': self.intensityHistogram(img)
-            }
-        return histograms
+    # cancelThumbnail
+    #
+    # Cancels the thumbnail a cell is still waiting for, so fast scrolling does not queue up
+    # thumbnails of cells that have already been reused
+    def cancelThumbnail(self, cell):
+        if cell['thumbnailFuture'] is not None:
+            cell['thumbnailFuture'].cancel()
+            cell['thumbnailFuture'] = None
+
+    # scrollTo
+    #
+    # Scrolls the grid to a pixel offset and redraws the cells in view
+    def scrollTo(self, offset):
+        self.scrollOffset = int(offset)
+        self.displayImages()
 
-    # intensityHistogram
+    # onScroll
     #
-    # Converts the input image to grayscale and creates a histogram with 25 bins,
-    # each representing a range of pixel intensities from 0 to 255
-    # Go through each pixel, sorts them into each of the 25 bins
-    # Count the occurrences in each bin
-    def intensityHistogram(self, img):
-    # Initializes a histogram with 25 bins
-        histogram = np.zeros(25, dtype=int)
+    # Scrollbar command, either ("moveto", fraction) or ("scroll", count, "units" or "pages")
+    def onScroll(self, action, amount, unit=None):
+        if action == "moveto":
+            numRows = (len(self.sortedImages) + self.gridColumns - 1) // self.gridColumns
+            self.scrollTo(float(amount) * numRows * self.cellSize[1])
+        elif unit == "pages":
+            self.scrollTo(self.scrollOffset + int(amount) * self.visibleRows() * self.cellSize[1])
+        else:
+            self.scrollTo(self.scrollOffset + int(amount) * self.scrollUnit)
 
-        # Convert the image to RGB (if it's not already in RGB format)
-        img = img.convert("RGB")
+    # onMouseWheel
+    #
+    # Scrolls the grid by one unit per wheel step, X11 reports the wheel as buttons 4 and 5
+    def onMouseWheel(self, event):
+        if getattr(event, 'num', None) in (4, 5):
+            steps = -1 if event.num == 4 else 1
+        else:
+            steps = -event.delta // 120 if abs(event.delta) >= 120 else -event.delta
+        self.scrollTo(self.scrollOffset + steps * self.scrollUnit)
 
-        # Create an array to hold pixels
-        pixels = np.array(img)
+    # onCanvasResize
+    #
+    # Adapts the number of cells to the new height of the canvas
+    def onCanvasResize(self, event):
+        if event.height != self.viewportHeight:
+            self.viewportHeight = event.height
+            self.displayImages()
 
-        # Go through each pixel's RGB values and calculate the intensity
-        for r, g, b in pixels.reshape(-1, 3):
-            value = 0.299 * r + 0.587 * g + 0.114 * b  # Calculate the intensity using the weighted formula
-            binIndex = min(int(value) // 10, 24)  # Group the value into a bin of ranges (0-9, 10-19, ..., 240-249)
-            histogram[binIndex] += 1  # Increment the corresponding bin in the histogram
+    # showThumbnail
+    #
+    # Shows a thumbnail in a label, straight from the cache when it is there,
+    # otherwise once a thumbnail worker has generated it
+    # Thumbnails that arrive when isCurrent() no longer holds (the label was redrawn meanwhile) are dropped,
+    # as are those of images deleted before they were loaded (the folder watcher removes them soon after)
+    # Returns the future of the background task, or None if the thumbnail was cached
+    def showThumbnail(self, label, imagePath, size, isCurrent):
+        def load():
+            try:
+                return self.thumbnailCache.get(imagePath, size)
+            except OSError:
+                return None
+
+        def setImage(imgResized):
+            if imgResized is None or not isCurrent():
+                return
+            imgTk = ImageTk.PhotoImage(imgResized)
+            label.configure(image=imgTk)
+            label.image = imgTk
 
-        return histogram
+        imgResized = self.thumbnailCache.peek(imagePath, size)
+        if imgResized is not None:
+            setImage(imgResized)
+            return None
+        return self.runInBackground(self.thumbnailPool, load, setImage)
 
-    # colorCodeHistogram
+    # displaySelectedImage
     #
-    # Converts the input image to RGB and creates a histogram with 64 bins,
-    # Go through each pixel RBG values, sorts them into each of the 64 bins
-    # Red contributes to 16 possible bins, green contributes 4 bins,
-    # and blue contributing 1 bin.
-    def colorCodeHistogram(self, img):
-        # Initializes a histogram with 64 bins
-        histogram = np.zeros(64, dtype=int)
+    # Displays the selected image
+    # Resizes the selected image to fit the display area
+    # Updates the name of current selected image to reflect the new one
+    # Selecting a new image cancels the query that is still running for the previous one
+    def displaySelectedImage(self, imgIndex):
+        self.cancelQuery()
 
-        # Convert the image to RGB
-        img = img.convert("RGB")
+        # Label selected image
+        self.selectedGeneration += 1
+        generation = self.selectedGeneration
+        self.showThumbnail(self.selectedImageLabel, self.imagePaths[imgIndex], self.selectedImageSize,
+                           lambda: generation == self.selectedGeneration)
 
-        # Create an array to hold pixels
-        pixels = np.array(img)
+        # Set the name and index of the currently selected image
+        self.selectedImageName = os.path.basename(self.imagePaths[imgIndex])
+        self.selectedImageIndex = imgIndex
 
-        # Go thorugh each pixel's RGB values and divide them by 64 to group them into one of 64 bins
-        # Multiplies by 16 because R contributes to 16 different bins
-        # Multiplies by 4 because G contributes to 4 different bins.
-        for r, g, b in pixels.reshape(-1, 3):
-            binIndex = (r // 64) * 16 + (g // 64) * 4 + (b // 64)
-            histogram[binIndex] += 1
+    # Upper
+    #
+    # Scrolls the grid up by one screen of images
+    def upper(self):
+        self.onScroll("scroll", -1, "pages")
 
-        return histogram
+    # Under
+    #
+    # Scrolls the grid down by one screen of images
+    def under(self):
+        self.onScroll("scroll", 1, "pages")
 
     # retrieveByIntensity
     #
@@ -312,45 +667,13 @@ class ImageViewer:
     # those of other images.
     # Sorts by the computed distances, and the display is updated to show the sorted images
     def retrieveByIntensity(self):
-        # Check if an image has been selected
-        if not self.selectedImageName:
+        # Check if an image has been selected and the features are indexed
+        if not self.selectedImageName or not self.indexReady:
             return
 
-        # Retrieve the histogram of the selected image and count its pixels
-        selectedHistogram = self.allHistograms[self.selectedImageName]['intensity']
-        numPixelsSelected = np.sum(selectedHistogram)
-
-        distances = []
-
-        # Go through the list of image and its histograms
-        for imageName, data in self.allHistograms.items():
-            if imageName == self.selectedImageName:
-                continue
-
-            histogram = data['intensity']
-
-            # Counts up all the intensity histograms
-            numPixels = np.sum(histogram)
-
-            # Perform manhattan distance
-            distance = self.manhattanDistance(
-                selectedHistogram, histogram, numPixelsSelected, numPixels)
-
-            # Get the current image index and put it into a list with its manhattan distance result
-            imageIndex = int(imageName.split('.')[0]) - 1
-            distances.append((imageIndex, distance))
-
-        # Sort distances in ascending order
-        distances.sort(key=lambda x: x[1])
-
-        # Get all the newly sorted images index and intert them into the sorted list
-        self.sortedImages = [index for index, _ in distances]
-        selectedImageIndex = int(self.selectedImageName.split('.')[0]) - 1
-        self.sortedImages.insert(0, selectedImageIndex)
-
-        # Reset current page to 0 and refresh grid based on current order
-        self.currentPage = 0
-        self.displayImages()
+        selectedImageIndex = self.selectedImageIndex
+        self.startQuery(lambda: retrieval.histogramDistances(self.imageIndex.normalizedIntensity, selectedImageIndex),
+                        "intensity", method="intensity")
 
     # retrieveByColorCode
     #
@@ -359,67 +682,31 @@ class ImageViewer:
     # those of other images.
     # Sorts by the computed distances, and the display is updated to show the sorted images
     def retrieveByColorCode(self):
-        # Check if an image has been selected
-        if not self.selectedImageName:
+        # Check if an image has been selected and the features are indexed
+        if not self.selectedImageName or not self.indexReady:
             return
 
-        # Retrieve the histogram of the selected image and count its pixels
-        selectedHistogram = self.allHistograms[self.selectedImageName]['colorCode']
-        numPixelsSelected = np.sum(selectedHistogram)
-
-        distances = []
-
-        # Go through the list of image and its histograms
-        for imageName, data in self.allHistograms.items():
-            if imageName == self.selectedImageName:
-                continue
-
-            histogram = data['colorCode']
-
-            # Counts up all the colorcode histograms
-            numPixels = np.sum(histogram)
-
-            # Perform manhattan distance
-            distance = self.manhattanDistance(
-                selectedHistogram, histogram, numPixelsSelected, numPixels)
+        selectedImageIndex = self.selectedImageIndex
+        self.startQuery(lambda: retrieval.histogramDistances(self.imageIndex.normalizedColorCode, selectedImageIndex),
+                        "colorCode", method="colorCode")
 
-            # Get the current image index and put it into a list with its manhattan distance result
-            imageIndex = int(imageName.split('.')[0]) - 1
-            distances.append((imageIndex, distance))
-
-        # Sort distances in ascending order
-        distances.sort(key=lambda x: x[1])
-
-        # Get all the newly sorted images index and intert them into the sorted list
-        self.sortedImages = [index for index, _ in distances]
-        selectedImageIndex = int(self.selectedImageName.split('.')[0]) - 1
-        self.sortedImages.insert(0, selectedImageIndex)
-
-        # Reset current page to 0 and refresh grid based on current order
-        self.currentPage = 0
-        self.displayImages()
-
-    # manhattanDistance
+    # showRanking
     #
-    # Calculates the Manhattan distance between two histograms
-    # takes two histograms and the total number of pixels in each histogram
-    # Returns infinity to indicate 0 pixels
-    # Computes the manhattan distance by summing the absolute differences of the
-    # normalized histogram values
-    def manhattanDistance(self, hisA, hisB, pixelsA, pixelsB):
-        if pixelsA == 0 or pixelsB == 0:
-            return float('inf')
-
-        return np.sum(np.abs(hisA / pixelsA - hisB / pixelsB))
+    # Shows the selected image first followed by the retrieved images in ranked order
+    # The ranking is lazy, only the pages that are displayed get sorted
+    # Scrolls back to the top and refreshes the grid based on the current order
+    def showRanking(self, ranking):
+        self.sortedImages = ranking
+        self.scrollTo(0)
 
     # resetOrder
     #
-    # Resets the order of images to their original sequence from 1 to 100
-    # Resets current page
+    # Resets the order of images to their original sequence in the folder
+    # Scrolls back to the top
     def resetOrder(self):
-        self.sortedImages = list(range(self.totalImages))
-        self.currentPage = 0
-        self.displayImages()
+        self.cancelQuery()
+        self.sortedImages = range(self.totalImages)
+        self.scrollTo(0)
 
     # onRelevanceToggle
     #
@@ -436,57 +723,6 @@ class ImageViewer:
         # Refresh the displayed images to add or remove relevance checkboxes
         self.displayImages()
         
-    # intensityAndColorCodeHistogram
-    #
-    # generates a combined histogram of intensity and color code values for an image
-    # The histograms are normalized by dividing each value by the image's total size width * height
-    def intensityAndColorCodeHistogram(self, img):
-        # Get intensity and color code histograms
-        intensity = self.intensityHistogram(img).astype(float)
-        colorCode = self.colorCodeHistogram(img).astype(float)
-        
-        # Get Image size using width and height
-        imageSize = img.size[0] * img.size[1]
-
-        # performs division on all intensity and color code value with image size befor combining them
-        if imageSize > 0:
-            intensity /= imageSize
-            colorCode /= imageSize
-
-        return np.concatenate((intensity, colorCode))
-
-    # precomputeHistograms
-    #
-    # Stores histograms for all images to optimize retrieval performance
-    def precomputeHistograms(self):
-        # Precompute histograms for all images
-        self.histograms = np.array([self.intensityAndColorCodeHistogram(img) for img in self.imageList])
-        
-    # calculateAverageAndStdDevHistogram
-    #
-    # Calculate Average and standard deviation for histograms
-    # Apply adjustments for any zero standard deviations
-    def calculateAverageAndStdDevHistogram(self):
-        # Calculate both average and standard deviation
-        self.averageHistogram = np.mean(self.histograms, axis=0)
-        self.stdDevHistogram = np.std(self.histograms, axis=0, ddof=1)
-        
-        # Adjust zero standard deviations with sti
-        nonZeroStdDevs = self.stdDevHistogram[self.stdDevHistogram > 0]
-        sti = 0.5 * np.min(nonZeroStdDevs) if nonZeroStdDevs.size > 0 else 0.5
-        self.adjustedStdDevHistogram = np.where(self.stdDevHistogram <= 0, sti, self.stdDevHistogram)
-
-    # gaussianNormalization
-    #
-    # Retrieves images sorted by their color code histogram based on the selected image
-    # calculates the Manhattan distance between the selected image's histogram and
-    # those of other images
-    # Sorts by the computed distances, and the display is updated to show the sorted images
-    def gaussianNormalization(self):
-        # Vectorized normalization using broadcasting
-        normalizedHistograms = (self.histograms - self.averageHistogram) / self.adjustedStdDevHistogram
-        return normalizedHistograms
-
     # retrieveByBothMethods
     #
     # Retrieves images based on combined intensity and color code similarity
@@ -495,86 +731,205 @@ class ImageViewer:
     # Sorts the image list by similarity to the selected image
     # Refreshes the display to show images ordered by relevance
     def retrieveByBothMethods(self):
-        # Check if an image has been selected
-        if not self.selectedImageName:
+        # Check if an image has been selected and the features are indexed
+        if not self.selectedImageName or not self.indexReady:
             return
 
-        # Precompute histograms and average and std dev histograms
-        if not hasattr(self, 'histograms'):
-            self.precomputeHistograms()
-            self.calculateAverageAndStdDevHistogram()
+        # Only use the relevant images when relevance is enabled, otherwise keep the weight at 1/89 default
+        relevantIndices = list(self.relevantIndices) if self.relevanceChecked.get() else []
 
-        # Get normalized Gaussian histograms
-        normalizedHistograms = self.gaussianNormalization()
-        
-        # Get selected image index
-        selectedImageIndex = int(self.selectedImageName.split('.')[0]) - 1
-        selectedHistogram = normalizedHistograms[selectedImageIndex]
+        selectedImageIndex = self.selectedImageIndex
+        self.startQuery(lambda: self.imageIndex.bothMethodsDistances(selectedImageIndex, relevantIndices), "both",
+                        method=None if relevantIndices else "both")
 
-        # Check if relevance is enabled
-        if self.relevanceChecked.get():
-            
-            # Check if there are any relevanct images selected
-            if self.relevantIndices:
-                # Update weights to reflect the relevant images selected
-                stdDevHistogram = self.updateRelevantWeight()
-                distances = np.sum(stdDevHistogram * np.abs(normalizedHistograms - selectedHistogram), axis=1)
+    # isRelevant
+    #
+    # Checks whether an image is in the sorted list of relevant indices
+    def isRelevant(self, index):
+        position = bisect.bisect_left(self.relevantIndices, index)
+        return position < len(self.relevantIndices) and self.relevantIndices[position] == index
+
+    # toggleRelevance
+    #
+    # Adds or removes one image from the sorted list of relevant indices when its checkbox is toggled
+    # The sorted list is the only record of which images are relevant, the checkboxes of the grid cells
+    # are set from it whenever a cell shows another image
+    def toggleRelevance(self, index, checked):
+        position = bisect.bisect_left(self.relevantIndices, index)
+        isListed = self.isRelevant(index)
+
+        if checked and not isListed:
+            self.relevantIndices.insert(position, index)
+        elif not checked and isListed:
+            del self.relevantIndices[position]
+
+    # refreshFolder
+    #
+    # Rescans the image folder and applies the differences to the index one image at a time
+    # Deleted images are removed, new images are decoded and added, and changed images are decoded again
+    # Images that cannot be decoded are skipped and remembered by their stamp, so they are only tried again
+    # once the file changes
+    # Waits for a query that is still reading the index
+    def refreshFolder(self):
+        if not self.indexReady:
+            return
+
+        trace = timing.Trace("refresh")
+        with timing.activate(trace), self.indexLock:
+            try:
+                currentPaths = listImages(self.imageFolder)
+                for imagePath in set(self.imagePaths) - set(currentPaths):
+                    self.removeImage(imagePath)
+                self.failedStamps = {path: stamp for path, stamp in self.failedStamps.items()
+                                     if path in currentPaths}
+
+                for imagePath in currentPaths:
+                    try:
+                        stamp = FeatureStore.fileStamp(imagePath)
+                    except OSError:
+                        continue  # Deleted between listing and stat
+                    stamp = (stamp['size'], stamp['mtime'])
+                    if self.failedStamps.get(imagePath) == stamp:
+                        continue
+                    if imagePath in self.imageIndex.rows and self.imageStamps.get(imagePath) == stamp:
+                        continue
+
+                    try:
+                        self.addImage(imagePath)
+                    except (OSError, ValueError):
+                        self.failedStamps[imagePath] = stamp
+                        continue
+                    self.failedStamps.pop(imagePath, None)
+                    self.imageStamps[imagePath] = stamp
+            finally:
+                self.resetOrder()
+        self.reportTrace(trace.finish())
+        if not self.showTimings.get():
+            skipped = f", {len(self.failedStamps)} could not be decoded" if self.failedStamps else ""
+            self.statusLabel.config(text=f"Indexed {self.totalImages} images{skipped}")
+
+    # onWatchToggle
+    #
+    # Starts or stops watching the image folder
+    def onWatchToggle(self):
+        if self.watchFolder.get():
+            self.startWatching()
+        else:
+            self.stopWatching()
+
+    # startWatching
+    #
+    # Starts a folder watcher that knows the indexed images and polls it from the Tk main loop
+    # Waits for the index to be ready, pollIndex starts the watcher once it is
+    def startWatching(self):
+        if not self.indexReady or self.folderWatcher is not None:
+            return
+        self.folderWatcher = FolderWatcher(self.imageFolder, self.imageStamps).start()
+        self.root.after(self.watchPollInterval, self.pollWatcher)
+
+    # stopWatching
+    #
+    # Stops the folder watcher, images it has not handed over yet are picked up by the next watcher or refresh
+    def stopWatching(self):
+        if self.folderWatcher is not None:
+            self.folderWatcher.stop()
+            self.folderWatcher = None
+
+    # pollWatcher
+    #
+    # Applies the images the watcher has finished to the index and keeps polling while watching
+    # Taking at most watchBatch results per poll keeps the window responsive during a burst of files,
+    # the rest waits in the watcher's bounded queues
+    # While a query is reading the index the results are left for the next poll instead of waiting for it
+    def pollWatcher(self):
+        watcher = self.folderWatcher
+        if watcher is None:
+            return
+        if not self.indexLock.acquire(blocking=False):
+            self.root.after(self.watchPollInterval, self.pollWatcher)
+            return
+
+        try:
+            events = watcher.drain(self.watchBatch)
+            if events:
+                self.applyWatchEvents(events)
+        finally:
+            self.indexLock.release()
+
+        if events:
+            if not self.showTimings.get():
+                backlog = watcher.backlog()
+                self.statusLabel.config(
+                    text=f"Indexed {self.totalImages} images" + (f", {backlog} pending" if backlog else ""))
+        self.root.after(self.watchPollInterval, self.pollWatcher)
+
+    # applyWatchEvents
+    #
+    # Adds, updates and removes the images reported by the watcher
+    # New images become queryable right away; the default order grows to include them and a ranking on
+    # screen is kept, unless images were removed, which moves rows around and resets the order
+    def applyWatchEvents(self, events):
+        trace = timing.Trace("watch")
+        with timing.activate(trace):
+            removed = False
+            for kind, imagePath, stamp, histograms in events:
+                if kind == "remove":
+                    if imagePath in self.imageIndex.rows:
+                        self.removeImage(imagePath)
+                        removed = True
+                elif histograms is not None:
+                    self.addImage(imagePath, histograms)
+                    self.imageStamps[imagePath] = stamp
+                    for cell in self.gridCells:
+                        if cell['imagePath'] == imagePath:
+                            cell['imagePath'] = None
+
+            if removed:
+                self.resetOrder()
             else:
-                # Keep weight at 1/89 default
-                distances = np.sum(np.abs(normalizedHistograms - selectedHistogram) / 89, axis=1)
+                if isinstance(self.sortedImages, range):
+                    self.sortedImages = range(self.totalImages)
+                self.displayImages()
+        self.reportTrace(trace.finish())
+
+    # addImage
+    #
+    # Decodes one image and adds it to the index, or updates it if it is already there
+    # Only this image is processed, the average and standard deviation are updated incrementally
+    # histograms are the image's (intensity, colorCode) histograms when they have been computed already
+    # New images are patched into the neighbour graph, a changed image makes it out of date
+    def addImage(self, imagePath, histograms=None):
+        intensity, colorCode = histograms if histograms is not None else extractHistograms(imagePath)
+        isNew = imagePath not in self.imageIndex.rows
+        row = self.imageIndex.add(imagePath, intensity, colorCode)
+        self.thumbnailCache.discard(imagePath)
+        self.totalImages = len(self.imageIndex)
+
+        if self.neighbourGraph is not None and isNew:
+            self.neighbourGraph.add(self.imageIndex, row)
         else:
-            # Keeps weight at 1/89 default
-            distances = np.sum(np.abs(normalizedHistograms - selectedHistogram) / 89, axis=1)
-     
-        # Ignore the selected image itself           
-        distances[selectedImageIndex] = np.inf 
-        
-        # Sort by distance in ascending order
-        sortedIndices = np.argsort(distances)
+            self.neighbourGraph = None
 
-        # Update sorted image list
-        self.sortedImages = [selectedImageIndex] + [index for index in sortedIndices if index != selectedImageIndex]
-        self.currentPage = 0
-        
-        self.displayImages()
-    
-    # updateRelevance
-    #
-    # Collects indices of images marked as relevant (checked) in the interface and storing them
-    def updateRelevance(self):
-        # Select only the histograms of relevant checked images
-        self.relevantIndices = [idx for idx, checked in self.relevanceState.items() if checked.get()]
-       
-    # updateRelevantWeight
-    #
-    # Calculates weights for relevant images selected by the user
-    # Retrieves histograms for relevant images, then calculates the standard deviation across
-    # bins, applying adjustments for any zero standard deviations
-    # The resulting weights normalize based on the sum of all updated values
-    def updateRelevantWeight(self):
-        # Retrieve normalized histograms
-        normalizedHistograms = self.gaussianNormalization()
-    
-        # Extract all relevant images and their histograms using relevant indices
-        relevantHistograms = [normalizedHistograms[i] for i in self.relevantIndices]
-        
-        # Get standard deviation for each bin
-        self.stdDevUpdate = np.std(relevantHistograms, axis=0, ddof=1)
-        
-        # Find all non zero standard deviations, and replace all zero standard deviations with
-        # 1/2 * min(all non zero standard deviations)
-        nonZeroStdDevsUpdate = self.stdDevUpdate[self.stdDevUpdate > 0]
-        self.stdDevUpdate[self.stdDevUpdate == 0] = 0.5 * np.min(nonZeroStdDevsUpdate)
-        
-        # Update histograms
-        updateHistogram = 1 / self.stdDevUpdate
-             
-        # Find the sum of all updates   
-        sumHistogram = np.sum(updateHistogram)
-        
-        # Normalize weight
-        updateHistogram /= sumHistogram
-    
-        # Return the normalized wight
-        return updateHistogram
-        
\ No newline at end of file
+    # removeImage
+    #
+    # Removes one image from the index
+    # The last image takes over the freed row, so its relevance state and selection move along with it
+    # The neighbour graph no longer matches the rows and is dropped
+    def removeImage(self, imagePath):
+        row, movedRow = self.imageIndex.remove(imagePath)
+        self.neighbourGraph = None
+        self.imageStamps.pop(imagePath, None)
+        self.thumbnailCache.discard(imagePath)
+        self.totalImages = len(self.imageIndex)
+
+        if self.selectedImageIndex == row:
+            self.selectedImageIndex = None
+            self.selectedImageName = None
+        elif movedRow is not None and self.selectedImageIndex == movedRow:
+            self.selectedImageIndex = row
+
+        movedIsRelevant = movedRow is not None and self.isRelevant(movedRow)
+        self.toggleRelevance(row, False)
+        if movedRow is not None:
+            self.toggleRelevance(movedRow, False)
+            self.toggleRelevance(row, movedIsRelevant)
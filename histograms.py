@@ -0,0 +1,211 @@
+import re
+
+import numpy as np
+
+
+# histograms
+#
+# Vectorized histogram engine for the intensity and color code methods
+#
+# Every function takes an RGB pixel array (uint8, last axis of size 3) and returns histogram counts
+# A single image is an array of shape (height, width, 3) and gives a 1D histogram,
+# a batch of equally sized images is an array of shape (batch, height, width, 3) and gives one row per image
+#
+# The bins are bit-identical to the original per-pixel loops in ImageViewer, they are just computed
+# over the whole array at once with np.bincount instead of one pixel at a time
+#
+# Besides the two fixed histograms an index can hold finer histograms described by a Quantization,
+# computed from the same decoded pixels (see the Quantization class for the available specs)
+
+INTENSITY_BINS = 25
+COLOR_CODE_BINS = 64
+NUM_FEATURES = INTENSITY_BINS + COLOR_CODE_BINS
+
+# Histograms are stored as unsigned counts, uint32 holds the counts of images up to 4 gigapixels
+COUNT_DTYPE = np.uint32
+
+
+# toPixels
+#
+# Converts a PIL image to an RGB uint8 pixel array
+# This is the only decode step needed for both histograms
+def toPixels(img):
+    return np.asarray(img.convert("RGB"))
+
+
+# binCount
+#
+# Counts the bin indices of one image or of a batch of images
+# For a batch every image gets its own offset range of bins so a single bincount covers all of them
+def binCount(binIndices, numBins):
+    if binIndices.ndim <= 2:
+        return np.bincount(binIndices.ravel(), minlength=numBins)
+
+    batchSize = binIndices.shape[0]
+    offsets = np.arange(batchSize, dtype=np.int64).reshape((batchSize,) + (1,) * (binIndices.ndim - 1)) * numBins
+    counts = np.bincount((binIndices + offsets).ravel(), minlength=batchSize * numBins)
+    return counts.reshape(batchSize, numBins)
+
+
+# intensityBins
+#
+# Computes the intensity bin of every pixel
+# Uses the same weighted formula and float64 arithmetic as the original loop so that values sitting
+# exactly on a bin border end up in the same bin, then groups them into bins of 10 (0-9, 10-19, ..., 240-255)
+def intensityBins(pixels):
+    r = pixels[..., 0].astype(np.float64)
+    g = pixels[..., 1].astype(np.float64)
+    b = pixels[..., 2].astype(np.float64)
+    value = 0.299 * r + 0.587 * g + 0.114 * b
+    return np.minimum(value.astype(np.int64) // 10, INTENSITY_BINS - 1)
+
+
+# colorCodeBins
+#
+# Computes the color code of every pixel from the most significant bits of each channel
+# With the default two bits per channel this is the 6 bit code where red contributes 16, green 4 and blue 1
+def colorCodeBins(pixels, bits=(2, 2, 2)):
+    pixels = pixels.astype(np.int64)
+    redBits, greenBits, blueBits = bits
+    return ((pixels[..., 0] >> (8 - redBits)) << (greenBits + blueBits)) \
+        + ((pixels[..., 1] >> (8 - greenBits)) << blueBits) + (pixels[..., 2] >> (8 - blueBits))
+
+
+# hsvBins
+#
+# Computes the HSV bin of every pixel, hue is split into hueBins sectors of the color wheel and
+# saturation and value into equal ranges
+# Gray pixels (no saturation) have hue 0
+def hsvBins(pixels, hueBins=18, saturationBins=3, valueBins=3):
+    pixels = pixels.astype(np.int64)
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    maxValue = np.max(pixels, axis=-1)
+    delta = maxValue - np.min(pixels, axis=-1)
+
+    hue = np.zeros(maxValue.shape)
+    chroma = np.where(delta > 0, delta, 1).astype(np.float64)
+    hue = np.where(maxValue == b, 4 + (r - g) / chroma, hue)
+    hue = np.where(maxValue == g, 2 + (b - r) / chroma, hue)
+    hue = np.where(maxValue == r, np.mod((g - b) / chroma, 6), hue)
+    hue = np.where(delta > 0, hue, 0)
+
+    hueBin = np.minimum((hue * hueBins / 6).astype(np.int64), hueBins - 1)
+    saturationBin = np.minimum(delta * saturationBins // np.maximum(maxValue, 1), saturationBins - 1)
+    valueBin = maxValue * valueBins // 256
+    return (hueBin * saturationBins + saturationBin) * valueBins + valueBin
+
+
+# gridBins
+#
+# Splits the image into a rows x columns grid and offsets the bin of every pixel by the cell it lies in,
+# so each cell gets its own numBins bins
+# Works on single images and on batches, the image is made of the two axes before the channel axis
+def gridBins(pixels, binIndices, numBins, rows, columns):
+    height, width = pixels.shape[-3:-1]
+    rowCells = np.arange(height) * rows // height
+    columnCells = np.arange(width) * columns // width
+    cells = rowCells[:, None] * columns + columnCells[None, :]
+    return binIndices + cells * numBins
+
+
+# intensityHistogram
+#
+# Creates the 25 bin intensity histogram of one image or a batch of images
+def intensityHistogram(pixels):
+    return binCount(intensityBins(pixels), INTENSITY_BINS)
+
+
+# colorCodeHistogram
+#
+# Creates the 64 bin color code histogram of one image or a batch of images
+def colorCodeHistogram(pixels):
+    return binCount(colorCodeBins(pixels), COLOR_CODE_BINS)
+
+
+# intensityAndColorCodeHistograms
+#
+# Creates both histograms from a single pixel array in one pass
+# Returns a tuple of (intensity, colorCode)
+def intensityAndColorCodeHistograms(pixels):
+    return intensityHistogram(pixels), colorCodeHistogram(pixels)
+
+
+# combinedFeature
+#
+# Concatenates the intensity and color code histograms and divides them by the number of pixels,
+# giving the 89 value feature used by the intensity and color code method
+# Works on single histograms and on batches (one row per image)
+def combinedFeature(intensity, colorCode):
+    intensity = np.asarray(intensity, dtype=float)
+    colorCode = np.asarray(colorCode, dtype=float)
+    imageSize = np.sum(intensity, axis=-1, keepdims=True)
+    combined = np.concatenate((intensity, colorCode), axis=-1)
+    return np.divide(combined, imageSize, out=combined, where=imageSize > 0)
+
+
+# compactCounts
+#
+# Returns histogram counts in the smallest unsigned integer type that holds them, uint16 or uint32
+def compactCounts(counts):
+    counts = np.asarray(counts)
+    dtype = np.uint16 if counts.size == 0 or counts.max() <= np.iinfo(np.uint16).max else COUNT_DTYPE
+    return counts.astype(dtype, copy=False)
+
+
+# class Quantization
+#
+# Configurable quantization of the pixels into histogram bins, described by a short spec string
+#
+#     color6, color8, color9, color12   color code with 2-2-2, 3-3-2, 3-3-3 or 4-4-4 bits of red, green and blue
+#     hsv, hsvHxSxV                     hue x saturation x value bins, 18x3x3 by default
+#     gridRxC, gridRxC-<spec>           the histogram of every cell of a rows x columns grid, by default of the
+#                                       6 bit color code, for example grid2x2 or grid3x3-hsv
+#
+# The finer quantizations tell apart images the 89 value combined histogram sees as identical,
+# the spec is used as the name of the histograms in the feature store
+class Quantization:
+
+    COLOR_BITS = {6: (2, 2, 2), 8: (3, 3, 2), 9: (3, 3, 3), 12: (4, 4, 4)}
+
+    # init
+    #
+    # Parses a spec string, raising ValueError for an unknown spec
+    def __init__(self, spec):
+        self.spec = spec
+        self.grid = None
+        self.base = None
+        self.bits = None
+        self.hsv = None
+
+        gridMatch = re.fullmatch(r"grid(\d+)x(\d+)(?:-(.+))?", spec)
+        colorMatch = re.fullmatch(r"color(\d+)", spec)
+        hsvMatch = re.fullmatch(r"hsv(?:(\d+)x(\d+)x(\d+))?", spec)
+        if gridMatch and int(gridMatch[1]) > 0 and int(gridMatch[2]) > 0:
+            self.grid = (int(gridMatch[1]), int(gridMatch[2]))
+            self.base = Quantization(gridMatch[3] or "color6")
+            self.numBins = self.grid[0] * self.grid[1] * self.base.numBins
+        elif colorMatch and int(colorMatch[1]) in self.COLOR_BITS:
+            self.bits = self.COLOR_BITS[int(colorMatch[1])]
+            self.numBins = 2 ** sum(self.bits)
+        elif hsvMatch and all(int(size) > 0 for size in hsvMatch.groups() if size is not None):
+            self.hsv = tuple(int(size) for size in hsvMatch.groups()) if hsvMatch[1] else (18, 3, 3)
+            self.numBins = self.hsv[0] * self.hsv[1] * self.hsv[2]
+        else:
+            raise ValueError(f"Unknown quantization {spec!r}, expected colorN (N one of "
+                             f"{sorted(self.COLOR_BITS)}), hsv, hsvHxSxV or gridRxC[-spec]")
+
+    # bins
+    #
+    # Computes the bin of every pixel of one image or a batch of images
+    def bins(self, pixels):
+        if self.grid:
+            return gridBins(pixels, self.base.bins(pixels), self.base.numBins, *self.grid)
+        if self.bits:
+            return colorCodeBins(pixels, self.bits)
+        return hsvBins(pixels, *self.hsv)
+
+    # histogram
+    #
+    # Creates the histogram of one image or a batch of images
+    def histogram(self, pixels):
+        return binCount(self.bins(pixels), self.numBins)
@@ -0,0 +1,315 @@
+import numpy as np
+
+import histograms as histogramEngine
+import retrieval
+import timing
+
+
+# class RunningStats
+#
+# Running average and standard deviation of the combined histograms
+#
+# Uses Welford's method so adding or removing one image updates the statistics in O(features)
+# instead of recomputing them over the whole library
+# The starting values are computed over the whole matrix the same way np.mean and np.std do
+class RunningStats:
+
+    # init
+    #
+    # Starts from the rows of a feature matrix
+    def __init__(self, features):
+        features = np.asarray(features, dtype=float)
+        self.count = len(features)
+        self.mean = np.mean(features, axis=0) if self.count else np.zeros(features.shape[1])
+        self.m2 = np.sum((features - self.mean) ** 2, axis=0)
+
+    # add
+    #
+    # Adds one row to the statistics
+    def add(self, row):
+        self.count += 1
+        delta = row - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (row - self.mean)
+
+    # remove
+    #
+    # Removes one row that was previously added
+    def remove(self, row):
+        if self.count <= 1:
+            self.count = 0
+            self.mean = np.zeros_like(self.mean)
+            self.m2 = np.zeros_like(self.m2)
+            return
+
+        delta = row - self.mean
+        self.count -= 1
+        self.mean = self.mean - delta / self.count
+        self.m2 = np.maximum(self.m2 - delta * (row - self.mean), 0)
+
+    # stdDev
+    #
+    # Sample standard deviation (ddof=1) of every feature
+    def stdDev(self):
+        if self.count < 2:
+            return np.zeros_like(self.m2)
+        return np.sqrt(self.m2 / (self.count - 1))
+
+
+# class ImageIndex
+#
+# In-memory, growable index of the features of an image library
+#
+# Holds the intensity and color code histograms divided by the image size and the pixel count of every
+# image, one row per image, in buffers with spare capacity so images can be added in amortized O(features)
+# Removing an image moves the last row into its place, so it is O(features) as well
+# Each method has its own contiguous matrix, so a scan for one method only reads that method's bins, and
+# the combined histograms (the 25 intensity bins followed by the 64 color code bins) are scored as the sum
+# of the weighted distances over the two matrices
+# The histogram counts are recovered exactly from the normalized histograms, so each feature is held only once
+# The average and standard deviation used by the Gaussian normalization are kept as running statistics,
+# and since the average cancels out in the distance between two normalized histograms the combined
+# method is scored on the combined histograms scaled by the standard deviation, so the normalized
+# matrix never has to be rebuilt when the library changes
+#
+# Everything derived from the whole library (statistics, the normalized matrix and the distance weights)
+# is cached and tagged with a version number that changes whenever an image is added or removed
+class ImageIndex:
+
+    # init
+    #
+    # Builds the index from image paths and their intensity and color code histograms
+    def __init__(self, paths, intensity, colorCode):
+        count = len(paths)
+        capacity = max(16, count)
+
+        self.paths = list(paths)
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+        self.intensityBuffer = np.zeros((capacity, histogramEngine.INTENSITY_BINS))
+        self.colorCodeBuffer = np.zeros((capacity, histogramEngine.COLOR_CODE_BINS))
+        self.pixelBuffer = np.zeros(capacity, dtype=histogramEngine.COUNT_DTYPE)
+
+        features = histogramEngine.combinedFeature(intensity, colorCode)
+        self.intensityBuffer[:count] = features[:, :histogramEngine.INTENSITY_BINS]
+        self.colorCodeBuffer[:count] = features[:, histogramEngine.INTENSITY_BINS:]
+        self.pixelBuffer[:count] = np.sum(intensity, axis=1)
+
+        self.refreshViews()
+        self.stats = RunningStats(features)
+        self.version = 0
+        self.cache = {}
+
+    # len
+    #
+    # Number of images in the index
+    def __len__(self):
+        return len(self.paths)
+
+    # refreshViews
+    #
+    # Points the public matrices at the used rows of the buffers
+    def refreshViews(self):
+        count = len(self.paths)
+        self.normalizedIntensity = self.intensityBuffer[:count]
+        self.normalizedColorCode = self.colorCodeBuffer[:count]
+        self.pixels = self.pixelBuffer[:count]
+
+    # featuresOf
+    #
+    # Combined histograms divided by the image size of one row or an array of rows
+    def featuresOf(self, rows):
+        return np.concatenate((self.normalizedIntensity[rows], self.normalizedColorCode[rows]), axis=-1)
+
+    # combinedFeatures
+    #
+    # Combined histograms of every image, copied out of the per-method matrices
+    # Only for whole-library work such as building an approximate index, queries use weightedDistances
+    def combinedFeatures(self):
+        return np.hstack((self.normalizedIntensity, self.normalizedColorCode))
+
+    # intensity
+    #
+    # Intensity histogram counts of every image
+    @property
+    def intensity(self):
+        return self.counts(self.normalizedIntensity)
+
+    # colorCode
+    #
+    # Color code histogram counts of every image
+    @property
+    def colorCode(self):
+        return self.counts(self.normalizedColorCode)
+
+    # counts
+    #
+    # Turns pixel count normalized histograms back into counts
+    # count / pixels * pixels is within a rounding error of count, so rounding gives the exact count back
+    def counts(self, normalizedHistograms):
+        return np.rint(normalizedHistograms * self.pixels[:, None]).astype(histogramEngine.COUNT_DTYPE)
+
+    # grow
+    #
+    # Doubles the capacity of every buffer
+    def grow(self):
+        for name in ("intensityBuffer", "colorCodeBuffer", "pixelBuffer"):
+            buffer = getattr(self, name)
+            grown = np.zeros((2 * len(buffer),) + buffer.shape[1:], dtype=buffer.dtype)
+            grown[:len(buffer)] = buffer
+            setattr(self, name, grown)
+
+    # cached
+    #
+    # Returns the cached value for key if it was computed for the current version of the index,
+    # otherwise computes it with compute() and caches it
+    def cached(self, key, compute):
+        entry = self.cache.get(key)
+        if entry is None or entry[0] != self.version:
+            with timing.span("normalization"):
+                entry = (self.version, compute())
+            self.cache[key] = entry
+        return entry[1]
+
+    # changed
+    #
+    # Marks every cached value as out of date
+    def changed(self):
+        self.version += 1
+        self.cache.clear()
+
+    # writeRow
+    #
+    # Stores the histograms of one image in a row of the buffers
+    def writeRow(self, row, intensity, colorCode):
+        feature = histogramEngine.combinedFeature(intensity, colorCode)
+        self.intensityBuffer[row] = feature[:histogramEngine.INTENSITY_BINS]
+        self.colorCodeBuffer[row] = feature[histogramEngine.INTENSITY_BINS:]
+        self.pixelBuffer[row] = np.sum(intensity)
+
+    # add
+    #
+    # Adds an image with its histograms, or replaces the histograms of an image already in the index
+    # Returns the row of the image
+    def add(self, path, intensity, colorCode):
+        row = self.rows.get(path)
+        if row is not None:
+            self.stats.remove(self.featuresOf(row))
+        else:
+            row = len(self.paths)
+            if row == len(self.pixelBuffer):
+                self.grow()
+            self.paths.append(path)
+            self.rows[path] = row
+            self.refreshViews()
+
+        self.writeRow(row, np.asarray(intensity), np.asarray(colorCode))
+        self.stats.add(self.featuresOf(row))
+        self.changed()
+        return row
+
+    # remove
+    #
+    # Removes an image, moving the last image into its row
+    # Returns (row, movedRow): the row that was freed and the old row of the image now stored there,
+    # or None for movedRow if the removed image was the last one
+    def remove(self, path):
+        row = self.rows.pop(path)
+        self.stats.remove(self.featuresOf(row))
+
+        last = len(self.paths) - 1
+        movedRow = None
+        if row != last:
+            for buffer in (self.intensityBuffer, self.colorCodeBuffer, self.pixelBuffer):
+                buffer[row] = buffer[last]
+            self.paths[row] = self.paths[last]
+            self.rows[self.paths[row]] = row
+            movedRow = last
+
+        self.paths.pop()
+        self.refreshViews()
+        self.changed()
+        return row, movedRow
+
+    # averageAndStdDev
+    #
+    # Average, standard deviation and adjusted standard deviation of the combined histograms
+    def averageAndStdDev(self):
+        def compute():
+            stdDev = self.stats.stdDev()
+            return self.stats.mean, stdDev, retrieval.adjustStdDev(stdDev)
+        return self.cached('stats', compute)
+
+    # normalizedHistograms
+    #
+    # Gaussian normalizes the combined histograms of the given rows, or of every image
+    # The matrix of every image is built once per version of the index
+    def normalizedHistograms(self, rows=None):
+        averageHistogram, _, adjustedStdDevHistogram = self.averageAndStdDev()
+        if rows is None:
+            return self.cached('normalized', lambda: retrieval.gaussianNormalization(
+                self.combinedFeatures(), averageHistogram, adjustedStdDevHistogram))
+        return retrieval.gaussianNormalization(self.featuresOf(list(rows)), averageHistogram, adjustedStdDevHistogram)
+
+    # bothMethodsWeights
+    #
+    # Weights applied to |x - q| by the combined method: the default 1/89 weights, or the weights derived
+    # from the relevant images, divided by the adjusted standard deviation
+    # Only recomputed when the index or the set of relevant images changes
+    def bothMethodsWeights(self, relevantIndices=()):
+        relevantIndices = tuple(sorted(relevantIndices))
+
+        # Keep only the weights of the latest relevant set
+        key = ('weights', relevantIndices)
+        for oldKey in [oldKey for oldKey in self.cache if oldKey[0] == 'weights' and oldKey != key]:
+            del self.cache[oldKey]
+        return self.cached(key, lambda: self.relevanceWeights(relevantIndices))
+
+    # relevanceWeights
+    #
+    # Computes the weights of bothMethodsWeights without caching them, for callers that keep their own
+    def relevanceWeights(self, relevantIndices=()):
+        _, _, adjustedStdDevHistogram = self.averageAndStdDev()
+        if len(relevantIndices):
+            weights = retrieval.relevantWeights(self.normalizedHistograms(relevantIndices))
+        else:
+            weights = np.full(histogramEngine.NUM_FEATURES, 1 / histogramEngine.NUM_FEATURES)
+        return weights / adjustedStdDevHistogram
+
+    # bothMethodsDistances
+    #
+    # Weighted Manhattan distance of every image's Gaussian normalized combined histogram to the query's
+    # |(x - mean) / std - (q - mean) / std| is |x - q| / std, so the weights are divided by the adjusted
+    # standard deviation and applied to the combined histograms directly
+    # Only the relevant images are normalized to derive their weights
+    def bothMethodsDistances(self, queryIndex, relevantIndices=()):
+        return self.queryDistances("both", self.featuresOf(queryIndex), relevantIndices)[0]
+
+    # weightedDistances
+    #
+    # Weighted Manhattan distance of every image's combined histograms to each row of a batch of query
+    # features, weights is one weight vector for every query or a matrix with one weight vector per query
+    # The distance is a sum over the features, so it is the sum of the distances over the intensity and the
+    # color code matrices and each scan reads contiguous rows
+    def weightedDistances(self, queryFeatures, weights=None):
+        queryFeatures = np.atleast_2d(queryFeatures)
+        split = histogramEngine.INTENSITY_BINS
+        intensityWeights = None if weights is None else np.asarray(weights)[..., :split]
+        colorCodeWeights = None if weights is None else np.asarray(weights)[..., split:]
+        distances = retrieval.l1Distances(queryFeatures[:, :split], self.normalizedIntensity, intensityWeights)
+        distances += retrieval.l1Distances(queryFeatures[:, split:], self.normalizedColorCode, colorCodeWeights)
+        return distances
+
+    # queryDistances
+    #
+    # Distance of every image to each row of a batch of query features (combined histograms divided by the
+    # image size, as in features) for one of the retrieval methods, in a single pass over the index
+    # The queries do not have to be in the index, relevantIndices only applies to the both method
+    def queryDistances(self, method, queryFeatures, relevantIndices=()):
+        queryFeatures = np.atleast_2d(queryFeatures)
+        if method == "intensity":
+            return retrieval.l1Distances(queryFeatures[:, :histogramEngine.INTENSITY_BINS], self.normalizedIntensity)
+        if method == "colorCode":
+            return retrieval.l1Distances(queryFeatures[:, histogramEngine.INTENSITY_BINS:], self.normalizedColorCode)
+        if method == "both":
+            return self.weightedDistances(queryFeatures, self.bothMethodsWeights(relevantIndices))
+        raise ValueError(f"Unknown retrieval method {method!r}, expected one of {retrieval.METHODS}")
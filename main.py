@@ -1,9 +1,16 @@
+import argparse
 import tkinter as tk
 from gui import ImageViewer
 
 def main():
+    parser = argparse.ArgumentParser(description="Content-based image retrieval browser")
+    parser.add_argument("--trace", help="JSON lines file the timing breakdown of every query is appended to")
+    parser.add_argument("--profile", help="folder cProfile statistics of every query are saved to")
+    parser.add_argument("--watch", action="store_true", help="index images landing in the folder while running")
+    args = parser.parse_args()
+
     root = tk.Tk()
-    app = ImageViewer(root)
+    app = ImageViewer(root, traceFile=args.trace, profileFolder=args.profile, watch=args.watch)
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,246 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import retrieval
+from extraction import defaultWorkers
+
+
+# class NeighbourGraph
+#
+# Precomputed top-k neighbours of every image for the three retrieval methods
+#
+# Built once from an image index (python cli.py neighbours build), after which a default query (no relevance
+# feedback) of an indexed image is a lookup of its row instead of a scan of the whole library
+# The build is an all-pairs computation split into blocks of query rows, every block is scored against
+# the library by the cache blocked l1Distances kernel and reduced to its top k right away, so memory stays
+# at one block of distances per worker, and the blocks run on a thread per core since NumPy releases the GIL
+#
+# Every method keeps an N x k matrix of neighbour rows, ranked as retrieval.topK ranks them, with their
+# distances, -1 marks the missing neighbours of libraries with k images or fewer
+# The both method is scored with the weights of the index when the graph was built, so a patched graph
+# stays consistent, rebuilding it picks up the statistics of the grown library
+# Images appended to the index are patched in with one scan per method: the new image gets its own
+# neighbours and is inserted into the lists of the images it is now one of the k closest to
+# Removing or changing an image invalidates the graph
+class NeighbourGraph:
+
+    FILE = "neighbours.npz"
+
+    # init
+    #
+    # Sets the number of neighbours kept per image
+    def __init__(self, k=50):
+        self.k = k
+        self.count = 0
+        self.indices = {}
+        self.distances = {}
+        self.weights = None
+        self.fingerprint = None
+
+    # len
+    #
+    # Number of images in the graph
+    def __len__(self):
+        return self.count
+
+    # allocate
+    #
+    # Creates the neighbour matrices of every method for capacity images, without any neighbours
+    def allocate(self, capacity):
+        for method in retrieval.METHODS:
+            indices = np.full((capacity, self.k), -1, dtype=np.int64)
+            distances = np.full((capacity, self.k), np.inf)
+            if method in self.indices:
+                indices[:self.count] = self.indices[method][:self.count]
+                distances[:self.count] = self.distances[method][:self.count]
+            self.indices[method] = indices
+            self.distances[method] = distances
+
+    # distancesTo
+    #
+    # Distances of every image of the index to a batch of query rows of combined histograms for one method
+    def distancesTo(self, imageIndex, method, queryFeatures):
+        if method == "both":
+            return imageIndex.weightedDistances(queryFeatures, self.weights)
+        return imageIndex.queryDistances(method, queryFeatures)
+
+    # build
+    #
+    # Computes the neighbours of every image of an image index, blockRows query images at a time
+    # on workers threads (one per core by default)
+    def build(self, imageIndex, workers=None, blockRows=64):
+        self.count = len(imageIndex)
+        self.weights = imageIndex.bothMethodsWeights()
+        self.indices = {}
+        self.distances = {}
+        self.allocate(max(1, self.count))
+
+        def buildBlock(start):
+            rows = np.arange(start, min(start + blockRows, self.count))
+            for method in retrieval.METHODS:
+                distances = self.distancesTo(imageIndex, method, imageIndex.featuresOf(rows))
+                indices, ranked = retrieval.topK(distances, self.k, exclude=rows)
+                self.indices[method][rows, :indices.shape[1]] = indices
+                self.distances[method][rows, :indices.shape[1]] = ranked
+
+        with ThreadPoolExecutor(max_workers=workers or defaultWorkers()) as executor:
+            list(executor.map(buildBlock, range(0, self.count, blockRows)))
+        return self
+
+    # add
+    #
+    # Patches an image that was just appended to the index (its row is the last one) into the graph
+    def add(self, imageIndex, row):
+        if row != self.count or row != len(imageIndex) - 1:
+            raise ValueError("Only the image appended last to the index can be patched into the graph")
+        if row == len(self.indices[retrieval.METHODS[0]]):
+            self.allocate(2 * row)
+        self.count += 1
+
+        for method in retrieval.METHODS:
+            distances = self.distancesTo(imageIndex, method, imageIndex.featuresOf(row))[0]
+            indices, ranked = retrieval.topK(distances, self.k, exclude=[row])
+            self.indices[method][row, :indices.shape[1]] = indices[0]
+            self.distances[method][row, :indices.shape[1]] = ranked[0]
+
+            # A list that is not full already holds every other image, otherwise the new image has to be
+            # closer than the last neighbour (on a tie the older image with the lower row stays first)
+            lists = self.indices[method][:row]
+            listDistances = self.distances[method][:row]
+            full = lists[:, -1] >= 0
+            for other in np.flatnonzero(~full | (distances[:row] < listDistances[:, -1])):
+                known = np.count_nonzero(lists[other] >= 0)
+                position = np.searchsorted(listDistances[other, :known], distances[other], side="right")
+                lists[other, position + 1:] = lists[other, position:-1].copy()
+                listDistances[other, position + 1:] = listDistances[other, position:-1].copy()
+                lists[other, position] = row
+                listDistances[other, position] = distances[other]
+
+    # neighbours
+    #
+    # Returns (indices, distances) of the closest images to an indexed image for one method,
+    # at most k of them (all stored neighbours by default)
+    def neighbours(self, method, row, k=None):
+        if method not in retrieval.METHODS:
+            raise ValueError(f"Unknown retrieval method {method!r}, expected one of {retrieval.METHODS}")
+        indices = self.indices[method][row]
+        known = int(np.count_nonzero(indices >= 0))
+        known = known if k is None else min(k, known)
+        return indices[:known], self.distances[method][row, :known]
+
+    # covers
+    #
+    # Checks whether the graph can answer a query for the top k images of a row
+    def covers(self, imageIndex, k):
+        return self.count == len(imageIndex) and k <= min(self.k, self.count - 1)
+
+    # ranking
+    #
+    # Returns the GraphRanking of an indexed image for one method, or None if the graph does not match the index
+    def ranking(self, imageIndex, method, row):
+        if self.count != len(imageIndex):
+            return None
+        indices, distances = self.neighbours(method, row)
+        return GraphRanking(indices, distances, row, self.count,
+                            lambda: self.distancesTo(imageIndex, method, imageIndex.featuresOf(row))[0])
+
+    # save
+    #
+    # Saves the graph to a .npz file together with the fingerprint of the index it was built from
+    def save(self, path, fingerprint=None):
+        arrays = {}
+        for method in retrieval.METHODS:
+            arrays[f"{method}Indices"] = self.indices[method][:self.count]
+            arrays[f"{method}Distances"] = self.distances[method][:self.count]
+        with open(path + ".tmp", 'wb') as f:
+            np.savez(f, k=self.k, weights=self.weights, fingerprint=fingerprint or "", **arrays)
+        os.replace(path + ".tmp", path)
+
+    # load
+    #
+    # Loads a graph saved with save, or returns None if there is none or it was built from another index
+    @classmethod
+    def load(cls, path, fingerprint=None):
+        try:
+            with np.load(path) as data:
+                if fingerprint is not None and str(data['fingerprint']) != fingerprint:
+                    return None
+                graph = cls(int(data['k']))
+                graph.weights = data['weights']
+                graph.fingerprint = str(data['fingerprint'])
+                for method in retrieval.METHODS:
+                    graph.indices[method] = data[f"{method}Indices"]
+                    graph.distances[method] = data[f"{method}Distances"]
+        except (OSError, ValueError, KeyError):
+            return None
+        graph.count = len(graph.indices[retrieval.METHODS[0]])
+        return graph
+
+
+# class GraphRanking
+#
+# Ranking of an indexed image answered from the neighbour graph
+#
+# Behaves like retrieval.Ranking, starting with the query image itself: the ranks covered by the graph are
+# looked up, and only asking for a rank past them computes the distances with computeDistances() and ranks
+# them with a Ranking, which orders images exactly as the graph does
+# The viewer calls full() on its query worker before it asks for ranks past rankedCount()
+class GraphRanking:
+
+    # init
+    #
+    # Takes the neighbours of the query from the graph, the query row, the number of images in the index
+    # and the function computing the distances of every image when more are needed
+    def __init__(self, indices, distances, queryIndex, numImages, computeDistances):
+        self.ranked = np.concatenate(([queryIndex], indices))
+        self.rankedDistances = np.concatenate(([0.0], distances))
+        self.queryIndex = queryIndex
+        self.numImages = numImages
+        self.computeDistances = computeDistances
+        self.fullRanking = None
+
+    # len
+    #
+    # Number of images in the ranking, query image included
+    def __len__(self):
+        return self.numImages
+
+    # rankedCount
+    #
+    # Number of leading ranks that can be read without computing any distances
+    def rankedCount(self):
+        return len(self) if self.fullRanking is not None else len(self.ranked)
+
+    # full
+    #
+    # The ranking of every image, computed the first time a rank past the graph is asked for
+    def full(self):
+        if self.fullRanking is None:
+            self.fullRanking = retrieval.Ranking(self.computeDistances(), self.queryIndex, len(self.ranked))
+        return self.fullRanking
+
+    # getitem
+    #
+    # Returns the image index at a rank, or a list of image indices for a slice of ranks
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if stop <= len(self.ranked):
+                return [int(index) for index in self.ranked[start:stop:step]]
+            return self.full()[key]
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("ranking index out of range")
+        return int(self.ranked[key]) if key < len(self.ranked) else self.full()[key]
+
+    # distanceAt
+    #
+    # Returns the distance of the image at a rank to the query
+    def distanceAt(self, rank):
+        if rank < len(self.ranked):
+            return float(self.rankedDistances[rank])
+        return self.full().distanceAt(rank)
@@ -0,0 +1,350 @@
+import numpy as np
+
+import timing
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+# retrieval
+#
+# Headless retrieval engine for the three histogram comparison methods
+#
+# Every function works on plain NumPy arrays with one row per image and never touches the GUI,
+# so the same ranking code is used by the Tk ImageViewer, the command line and batch jobs
+# A retrieval returns the ranked image indices (closest first, the query itself left out)
+# together with their distances to the query
+
+METHODS = ("intensity", "colorCode", "both")
+
+# Distances are computed over blocks of database rows small enough for their temporaries to stay in cache
+BLOCK_BYTES = 1024 * 1024
+
+# numexpr evaluates |x - q| on all cores when it is installed and selected with setDistanceEngine,
+# the weighted sums are done by NumPy in both cases so the distances are identical
+ENGINES = ("numpy", "numexpr")
+distanceEngine = "numpy"
+
+
+# manhattanDistance
+#
+# Calculates the Manhattan distance between two histograms
+# takes two histograms and the total number of pixels in each histogram
+# Returns infinity to indicate 0 pixels
+# Computes the manhattan distance by summing the absolute differences of the
+# normalized histogram values
+def manhattanDistance(hisA, hisB, pixelsA, pixelsB):
+    if pixelsA == 0 or pixelsB == 0:
+        return float('inf')
+
+    return np.sum(np.abs(hisA / pixelsA - hisB / pixelsB))
+
+
+# normalizeHistograms
+#
+# Divides every histogram by its pixel count so the Manhattan distance no longer has to per pair
+# Returns a contiguous float matrix, histograms without any pixels become NaN rows
+def normalizeHistograms(histograms):
+    histograms = np.asarray(histograms, dtype=float)
+    pixels = np.sum(histograms, axis=1, keepdims=True)
+    normalized = np.full(histograms.shape, np.nan)
+    np.divide(histograms, pixels, out=normalized, where=pixels > 0)
+    return np.ascontiguousarray(normalized)
+
+
+# setDistanceEngine
+#
+# Selects how l1Distances evaluates the absolute differences, "numpy" or "numexpr"
+def setDistanceEngine(engine):
+    global distanceEngine
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown distance engine {engine!r}, expected one of {ENGINES}")
+    if engine == "numexpr" and numexpr is None:
+        raise ValueError("The numexpr distance engine needs the numexpr package")
+    distanceEngine = engine
+
+
+# l1Distances
+#
+# Calculates the (weighted) Manhattan distance from every query row to every database row
+# Fused kernel: every block of database rows goes through subtract and abs in one preallocated buffer of at
+# most maxBytes, so the whole pass stays in cache and allocates nothing per block no matter how many images
+# there are
+# The weighted row sums are a matrix-vector product with the weights, which multiplies and sums in one go
+# and is several times faster than a separate multiply and sum over short rows
+# The database rows are expected to be normalized already, so nothing is divided per pair
+# weights is either one weight vector for every query or a matrix with one weight vector per query
+# Distances involving a NaN row (an image without pixels) are infinity
+def l1Distances(queries, database, weights=None, maxBytes=BLOCK_BYTES):
+    with timing.span("distance"):
+        queries = np.atleast_2d(queries)
+        numQueries, numFeatures = queries.shape
+        if weights is not None and np.ndim(weights) == 2:
+            weights = np.asarray(weights)[:, :, None]
+        distances = np.empty((numQueries, len(database)))
+        blockRows = max(1, maxBytes // (8 * numQueries * numFeatures))
+        buffer = np.empty((numQueries, min(blockRows, len(database)), numFeatures))
+        queryRows = queries[:, None, :]
+
+        for start in range(0, len(database), blockRows):
+            rows = database[start:start + blockRows][None]
+            difference = buffer if rows.shape[1] == buffer.shape[1] else np.empty((numQueries,) + rows.shape[1:])
+            if distanceEngine == "numexpr":
+                numexpr.evaluate("abs(rows - queryRows)", out=difference)
+            else:
+                np.subtract(queryRows, rows, out=difference)
+                np.abs(difference, out=difference)
+            target = distances[:, start:start + rows.shape[1]]
+            if weights is None:
+                np.sum(difference, axis=2, out=target)
+            elif np.ndim(weights) == 1:
+                np.matmul(difference, weights, out=target)
+            else:
+                np.matmul(difference, weights, out=target[:, :, None])
+
+        distances[np.isnan(distances)] = np.inf
+        return distances
+
+
+# topK
+#
+# Selects the k smallest distances of every row with argpartition and only sorts those
+# The excluded index of each row (usually the query itself) is left out, ties keep the image order
+# k is None to rank every image, a negative k raises ValueError
+# Returns (indices, distances), each with one row per query
+def topK(distances, k, exclude=None):
+    if k is not None and k < 0:
+        raise ValueError(f"k must not be negative, got {k}")
+    with timing.span("sort"):
+        distances = np.array(np.atleast_2d(distances), dtype=float)
+        numQueries, numImages = distances.shape
+        if exclude is not None:
+            distances[np.arange(numQueries), exclude] = np.nan
+            numImages -= 1
+        k = numImages if k is None else min(k, numImages)
+
+        # NaN sorts after infinity, so the excluded images never make it into the first k
+        # argpartition picks any of the images tied with the k-th distance, rows where some of those were left
+        # out take the tied images with the lowest indices instead, so the first k follow the image order too
+        if k < distances.shape[1]:
+            candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            kth = np.max(np.take_along_axis(distances, candidates, axis=1), axis=1, keepdims=True) if k else None
+            tiedRows = [] if kth is None else np.count_nonzero(distances == kth, axis=1) > np.count_nonzero(
+                np.take_along_axis(distances, candidates, axis=1) == kth, axis=1)
+            for row in np.flatnonzero(tiedRows):
+                closer = np.flatnonzero(distances[row] < kth[row])
+                candidates[row] = np.concatenate((closer, np.flatnonzero(distances[row] == kth[row])[:k - len(closer)]))
+        else:
+            candidates = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+
+        candidateDistances = np.take_along_axis(distances, candidates, axis=1)
+        order = np.lexsort((candidates, candidateDistances), axis=1)[:, :k]
+        indices = np.take_along_axis(candidates, order, axis=1)
+        return indices, np.take_along_axis(candidateDistances, order, axis=1)
+
+
+# histogramDistances
+#
+# Manhattan distance of every pixel count normalized histogram to the query's
+def histogramDistances(normalizedHistograms, queryIndex):
+    return l1Distances(normalizedHistograms[queryIndex], normalizedHistograms)[0]
+
+
+# retrieveByHistogram
+#
+# Ranks all images by the Manhattan distance of their pixel count normalized histograms to the query's
+# Only the first k images are ranked when k is given
+def retrieveByHistogram(normalizedHistograms, queryIndex, k=None):
+    distances = histogramDistances(normalizedHistograms, queryIndex)
+    indices, distances = topK(distances, k, exclude=[queryIndex])
+    return indices[0], distances[0]
+
+
+# retrieveByIntensity
+#
+# Ranks all images by their intensity histogram distance to the query image
+# Takes the pixel count normalized intensity histograms
+def retrieveByIntensity(normalizedIntensity, queryIndex, k=None):
+    return retrieveByHistogram(normalizedIntensity, queryIndex, k)
+
+
+# retrieveByColorCode
+#
+# Ranks all images by their color code histogram distance to the query image
+# Takes the pixel count normalized color code histograms
+def retrieveByColorCode(normalizedColorCode, queryIndex, k=None):
+    return retrieveByHistogram(normalizedColorCode, queryIndex, k)
+
+
+# adjustStdDev
+#
+# Replaces zero standard deviations by half of the smallest non zero one (or 0.5 if all are zero)
+def adjustStdDev(stdDevHistogram):
+    nonZeroStdDevs = stdDevHistogram[stdDevHistogram > 0]
+    sti = 0.5 * np.min(nonZeroStdDevs) if nonZeroStdDevs.size > 0 else 0.5
+    return np.where(stdDevHistogram <= 0, sti, stdDevHistogram)
+
+
+# averageAndStdDev
+#
+# Calculate Average and standard deviation for the combined histograms
+# Zero standard deviations are replaced by half of the smallest non zero one
+# Returns the tuple (average, stdDev, adjustedStdDev)
+def averageAndStdDev(histograms):
+    averageHistogram = np.mean(histograms, axis=0)
+    stdDevHistogram = np.std(histograms, axis=0, ddof=1)
+    return averageHistogram, stdDevHistogram, adjustStdDev(stdDevHistogram)
+
+
+# gaussianNormalization
+#
+# Normalizes every feature of the combined histograms to zero mean and unit standard deviation
+def gaussianNormalization(histograms, averageHistogram, adjustedStdDevHistogram):
+    return (histograms - averageHistogram) / adjustedStdDevHistogram
+
+
+# relevantWeights
+#
+# Calculates weights from the Gaussian normalized histograms of the images marked as relevant
+# Takes the standard deviation of each feature across the relevant images, replaces zero standard
+# deviations with 1/2 * min(all non zero standard deviations) and normalizes the inverse so it sums to one
+# A single relevant image or identical relevant images do not tell which features matter,
+# so they get the default weight 1/89 for every feature
+def relevantWeights(relevantHistograms):
+    relevantHistograms = np.atleast_2d(relevantHistograms)
+    numFeatures = relevantHistograms.shape[1]
+    if len(relevantHistograms) < 2:
+        return np.full(numFeatures, 1 / numFeatures)
+
+    stdDevUpdate = np.std(relevantHistograms, axis=0, ddof=1)
+    nonZeroStdDevsUpdate = stdDevUpdate[stdDevUpdate > 0]
+    if nonZeroStdDevsUpdate.size == 0:
+        return np.full(numFeatures, 1 / numFeatures)
+    stdDevUpdate[stdDevUpdate == 0] = 0.5 * np.min(nonZeroStdDevsUpdate)
+
+    updateHistogram = 1 / stdDevUpdate
+    updateHistogram /= np.sum(updateHistogram)
+    return updateHistogram
+
+
+# bothMethodsDistances
+#
+# Weighted Manhattan distance of every Gaussian normalized combined histogram to the query's
+# Without relevant images every feature gets the default weight 1/89, otherwise the weights are
+# derived from the relevant images
+def bothMethodsDistances(normalizedHistograms, queryIndex, relevantIndices=()):
+    selectedHistogram = normalizedHistograms[queryIndex]
+
+    if len(relevantIndices):
+        with timing.span("normalization"):
+            weights = relevantWeights(normalizedHistograms[list(relevantIndices)])
+    else:
+        weights = np.full(normalizedHistograms.shape[1], 1 / normalizedHistograms.shape[1])
+
+    return l1Distances(selectedHistogram, normalizedHistograms, weights)[0]
+
+
+# retrieveByBothMethods
+#
+# Ranks all images by the weighted Manhattan distance of their Gaussian normalized combined histograms
+# Only the first k images are ranked when k is given
+def retrieveByBothMethods(normalizedHistograms, queryIndex, relevantIndices=(), k=None):
+    distances = bothMethodsDistances(normalizedHistograms, queryIndex, relevantIndices)
+    indices, distances = topK(distances, k, exclude=[queryIndex])
+    return indices[0], distances[0]
+
+
+# normalizeFeatures
+#
+# Gaussian normalizes the combined histograms of a feature store
+def normalizeFeatures(features):
+    features = np.asarray(features)
+    averageHistogram, _, adjustedStdDevHistogram = averageAndStdDev(features)
+    return gaussianNormalization(features, averageHistogram, adjustedStdDevHistogram)
+
+
+# cascadeRetrieve
+#
+# Coarse-to-fine retrieval: the numCandidates images closest to each query by the cheap coarse distances
+# (any of the three methods on the 89 value features) are re-ranked by the Manhattan distance of their
+# finer histograms, so only the candidates' fine histograms are read and normalized
+# Takes one row of coarse distances per query, the fine histogram counts of every image and those of the
+# queries, exclude is left out of the candidates as in topK
+# Returns (indices, distances) with one row of k results per query, ranked by the fine distance
+def cascadeRetrieve(coarseDistances, fineCounts, queryFineCounts, k, numCandidates, exclude=None):
+    candidates, _ = topK(coarseDistances, max(k, numCandidates), exclude)
+    candidates.sort(axis=1)
+    queryFine = normalizeHistograms(np.atleast_2d(queryFineCounts))
+
+    indices = np.empty((len(candidates), min(k, candidates.shape[1])), dtype=np.int64)
+    distances = np.empty(indices.shape)
+    for row, rowCandidates in enumerate(candidates):
+        with timing.span("normalization"):
+            candidateFine = normalizeHistograms(fineCounts[rowCandidates])
+        order, distances[row] = topK(l1Distances(queryFine[row], candidateFine), k)
+        indices[row] = rowCandidates[order[0]]
+    return indices, distances
+
+
+# class Ranking
+#
+# Lazily ranked retrieval result
+#
+# Holds the distances of one query and behaves like the list of image indices in ranked order,
+# starting with the query image itself
+# Only as many images as have been asked for are ranked, using partial selection, and the ranking
+# is extended (at least doubling each time) when a later page is requested, so a query costs
+# one distance pass plus sorting the pages the user actually looks at
+class Ranking:
+
+    # init
+    #
+    # Takes the distance of every image to the query and the query index
+    # pageSize is how many images are ranked up front
+    def __init__(self, distances, queryIndex, pageSize=20):
+        self.distances = np.asarray(distances, dtype=float)
+        self.queryIndex = queryIndex
+        self.ranked = np.array([queryIndex])
+        self.extend(pageSize + 1)
+
+    # len
+    #
+    # Number of images in the ranking, query image included
+    def __len__(self):
+        return len(self.distances)
+
+    # extend
+    #
+    # Makes sure at least the first count images are ranked
+    def extend(self, count):
+        count = min(count, len(self))
+        if count <= len(self.ranked):
+            return
+
+        count = min(max(count, 2 * len(self.ranked)), len(self))
+        indices, _ = topK(self.distances, count - 1, exclude=[self.queryIndex])
+        self.ranked = np.concatenate(([self.queryIndex], indices[0]))
+
+    # getitem
+    #
+    # Returns the image index at a rank, or a list of image indices for a slice of ranks
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            self.extend(stop)
+            return [int(index) for index in self.ranked[start:stop:step]]
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("ranking index out of range")
+        self.extend(key + 1)
+        return int(self.ranked[key])
+
+    # distanceAt
+    #
+    # Returns the distance of the image at a rank to the query
+    def distanceAt(self, rank):
+        return float(self.distances[self[rank]])
@@ -0,0 +1,439 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+import histograms as histogramEngine
+import retrieval
+from extraction import extractHistograms
+from featurestore import FeatureStore
+from feedback import FeedbackSessions
+from imageindex import ImageIndex
+from neighbours import NeighbourGraph
+
+
+# server
+#
+# Local HTTP query service on a warm in-memory image index, built on asyncio without extra dependencies
+#
+# The feature index is loaded once at startup (build it first with python cli.py index) and every
+# request is answered from memory:
+#     GET  /health                                      number of indexed images
+#     GET  /query?image=5.jpg&method=both&k=20          query by an indexed image (name, path or row)
+#     POST /query     {"image": "5.jpg", "method": "colorCode", "k": 10}
+#     POST /upload?method=both&k=20                      query by the image file sent as the request body
+#     POST /feedback  {"image": "5.jpg", "relevant": ["5.jpg", "7.jpg"], "k": 20}
+#     POST /feedback  {"session": "<id>", "relevant": ["12.jpg"], "nonRelevant": ["40.jpg"], "k": 20}
+# /feedback opens a relevance feedback session for an indexed image and answers with its id, later rounds
+# send the id with the images judged in that round (see feedback.FeedbackSession)
+# A session starts with the Rocchio weights alpha 1, beta 0.75 and gamma 0.15 unless the opening request
+# gives others, beta and gamma 0 keep the query point and only reweight the features
+# The other endpoints accept a "relevant" list for a one off query of the both method
+# With a neighbour graph saved next to the index (python cli.py neighbours build), queries by an indexed image
+# without relevant images are answered by looking up its neighbours, without a distance pass (batchSize 0)
+#
+# Queries that arrive within batchWindow seconds of each other are batched: queries of the same method
+# and relevant images, and the rounds of all feedback sessions, share one vectorized distance pass over the
+# index, which runs on a worker thread so the event loop keeps accepting requests
+#     python server.py --port 8765
+#     curl 'http://127.0.0.1:8765/query?image=5.jpg&k=5'
+#     curl --data-binary @photo.jpg 'http://127.0.0.1:8765/upload?method=colorCode'
+
+MAX_BODY_BYTES = 32 * 1024 * 1024
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+# class HTTPError
+#
+# Error answered with an HTTP status code and a JSON error message
+class HTTPError(Exception):
+
+    # init
+    #
+    # Sets the status code and the message
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# class QueryService
+#
+# Answers retrieval queries on an image index, batching the queries that arrive close together
+class QueryService:
+
+    # init
+    #
+    # Takes the image index, how long to wait for more queries before running a batch (in seconds),
+    # the largest number of queries in one batch, the largest number of open feedback sessions
+    # and the neighbour graph of the index, if there is one
+    def __init__(self, imageIndex, batchWindow=0.002, maxBatch=64, maxSessions=1024, graph=None):
+        self.imageIndex = imageIndex
+        self.graph = graph
+        self.batchWindow = batchWindow
+        self.maxBatch = maxBatch
+        self.sessions = FeedbackSessions(imageIndex, maxSessions)
+        self.pending = []
+        self.flushHandle = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.rows = {}
+        for row, path in enumerate(imageIndex.paths):
+            self.rows[path] = row
+            self.rows[os.path.normpath(path)] = row
+            self.rows.setdefault(os.path.basename(path), row)
+
+        # Compute the statistics and default weights now so the first query does not pay for them
+        imageIndex.bothMethodsWeights()
+
+    # resolve
+    #
+    # Maps an image name, path or row number to a row of the index
+    def resolve(self, image):
+        if isinstance(image, int) or (isinstance(image, str) and image.isdigit()):
+            row = int(image)
+            if 0 <= row < len(self.imageIndex):
+                return row
+        elif isinstance(image, str):
+            row = self.rows.get(image, self.rows.get(os.path.normpath(image)))
+            if row is not None:
+                return row
+        raise HTTPError(404, f"Image {image!r} is not in the index")
+
+    # query
+    #
+    # Queues one query and waits for its batch to run
+    # features is the query's row of combined histograms, exclude the row left out of the results (if any)
+    # A query of a feedback session passes the session instead, which holds its query point and weights
+    # Returns (indices, distances) of the k closest images
+    async def query(self, method, features, k, relevantIndices=(), exclude=None, session=None):
+        if method not in retrieval.METHODS:
+            raise HTTPError(400, f"Unknown retrieval method {method!r}, expected one of {retrieval.METHODS}")
+        if method != "both" and relevantIndices:
+            raise HTTPError(400, "Relevant images only apply to the both method")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append({'method': method, 'features': features, 'k': k, 'exclude': exclude,
+                             'relevant': tuple(sorted(set(relevantIndices))), 'session': session, 'future': future})
+
+        if len(self.pending) >= self.maxBatch:
+            self.flush()
+        elif self.flushHandle is None:
+            self.flushHandle = loop.call_later(self.batchWindow, self.flush)
+        return await future
+
+    # flush
+    #
+    # Hands the queued queries to the worker thread as one batch
+    def flush(self):
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.get_running_loop().create_task(self.runBatch(batch))
+
+    # runBatch
+    #
+    # Runs a batch on the worker thread and passes every result (or error) to its waiting query
+    async def runBatch(self, batch):
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self.computeBatch, batch)
+        except Exception as error:
+            results = [error] * len(batch)
+
+        self.batches += 1
+        for request, result in zip(batch, results):
+            if request['future'].done():
+                continue
+            if isinstance(result, Exception):
+                request['future'].set_exception(result)
+            else:
+                request['future'].set_result(result + (len(batch),))
+
+    # computeBatch
+    #
+    # Groups the queries of a batch by method and relevant images, with the queries of all feedback sessions
+    # in one group, computes the distances of each group in a single pass over the index and ranks the
+    # k closest images of every query
+    def computeBatch(self, batch):
+        groups = {}
+        for position, request in enumerate(batch):
+            key = ("feedback", ()) if request['session'] else (request['method'], request['relevant'])
+            groups.setdefault(key, []).append(position)
+
+        results = [None] * len(batch)
+        for (method, relevantIndices), positions in groups.items():
+            if method == "feedback":
+                distances = self.sessions.distances([batch[position]['session'] for position in positions])
+            else:
+                queryFeatures = np.stack([batch[position]['features'] for position in positions])
+                distances = self.imageIndex.queryDistances(method, queryFeatures, relevantIndices)
+            for row, position in enumerate(positions):
+                request = batch[position]
+                exclude = None if request['exclude'] is None else [request['exclude']]
+                indices, ranked = retrieval.topK(distances[row], request['k'], exclude=exclude)
+                results[position] = (indices[0], ranked[0])
+        return results
+
+    # imageFeatures
+    #
+    # Decodes an uploaded image and returns its row of combined histograms
+    def imageFeatures(self, data):
+        try:
+            intensity, colorCode = extractHistograms(io.BytesIO(data))
+        except Exception as error:
+            raise HTTPError(400, f"Could not decode the uploaded image: {error}")
+        return histogramEngine.combinedFeature(intensity, colorCode)
+
+    # answer
+    #
+    # JSON answer for a finished query
+    def answer(self, query, method, result):
+        indices, distances, batchSize = result
+        return {'query': query, 'method': method, 'batchSize': batchSize, 'results': [
+            {'row': int(index), 'path': self.imageIndex.paths[index], 'distance': float(distance)}
+            for index, distance in zip(indices, distances)]}
+
+    # queryByImage
+    #
+    # Query by an indexed image, the image itself is left out of the results
+    # Looked up in the neighbour graph when it holds enough neighbours and no relevant images are given
+    async def queryByImage(self, params):
+        row = self.resolve(params.get('image'))
+        method = params.get('method', "both")
+        relevantIndices = [self.resolve(image) for image in readImages(params, 'relevant')]
+        k = readK(params)
+        if self.graph is not None and not relevantIndices and method in retrieval.METHODS \
+                and self.graph.covers(self.imageIndex, k):
+            indices, distances = self.graph.neighbours(method, row, k)
+            return self.answer(self.imageIndex.paths[row], method, (indices, distances, 0))
+        result = await self.query(method, self.imageIndex.featuresOf(row), k, relevantIndices, exclude=row)
+        return self.answer(self.imageIndex.paths[row], method, result)
+
+    # feedback
+    #
+    # Opens a feedback session for an indexed image, or adds a round of judged images to an open session,
+    # and answers the query of the session with its id and number of rounds
+    async def feedback(self, params):
+        sessionId = params.get('session')
+        if sessionId is None:
+            row = self.resolve(params.get('image'))
+            try:
+                rocchio = {name: float(params[name]) for name in ("alpha", "beta", "gamma") if name in params}
+            except (TypeError, ValueError):
+                raise HTTPError(400, "alpha, beta and gamma must be numbers")
+            sessionId = self.sessions.start(self.imageIndex.featuresOf(row), exclude=row, **rocchio)
+
+        try:
+            session = self.sessions.get(sessionId)
+        except (KeyError, TypeError):
+            raise HTTPError(404, f"No feedback session {sessionId!r}, it may have expired")
+
+        relevant = [self.resolve(image) for image in readImages(params, 'relevant')]
+        nonRelevant = [self.resolve(image) for image in readImages(params, 'nonRelevant')]
+        rounds = len(session.rounds)
+        if relevant or nonRelevant:
+            rounds = self.sessions.addRound(session, relevant, nonRelevant)
+
+        k = readK(params)
+        result = await self.query("both", None, k, exclude=session.exclude, session=session)
+        query = self.imageIndex.paths[session.exclude] if session.exclude is not None else "session"
+        return {'session': sessionId, 'round': rounds, **self.answer(query, "both", result)}
+
+    # queryByUpload
+    #
+    # Query by an image sent as the request body
+    async def queryByUpload(self, params, data):
+        if not data:
+            raise HTTPError(400, "The request body must be an image file")
+        features = await asyncio.get_running_loop().run_in_executor(None, self.imageFeatures, data)
+        method = params.get('method', "both")
+        relevantIndices = [self.resolve(image) for image in readImages(params, 'relevant')]
+        result = await self.query(method, features, readK(params), relevantIndices)
+        return self.answer("upload", method, result)
+
+    # handle
+    #
+    # Routes a request to its endpoint and returns the JSON answer
+    async def handle(self, httpMethod, path, params, body):
+        if path == "/health":
+            return {'images': len(self.imageIndex), 'batches': self.batches, 'sessions': len(self.sessions)}
+
+        if path == "/query" and httpMethod == "GET":
+            return await self.queryByImage(params)
+        if path == "/query" and httpMethod == "POST":
+            return await self.queryByImage(readJson(body))
+        if path == "/feedback" and httpMethod == "POST":
+            return await self.feedback(readJson(body))
+        if path == "/upload" and httpMethod == "POST":
+            return await self.queryByUpload(params, body)
+
+        if path in ("/query", "/feedback", "/upload"):
+            raise HTTPError(405, f"{httpMethod} is not supported on {path}")
+        raise HTTPError(404, f"No endpoint {path}")
+
+
+# readK
+#
+# Reads the number of results of a query, 20 by default
+def readK(params):
+    try:
+        k = int(params.get('k', 20))
+    except (TypeError, ValueError):
+        raise HTTPError(400, "k must be a number")
+    if k < 1:
+        raise HTTPError(400, "k must be at least 1")
+    return k
+
+
+# readImages
+#
+# Reads a list of image names or rows, empty by default
+def readImages(params, name):
+    images = params.get(name, [])
+    if not isinstance(images, list):
+        raise HTTPError(400, f"{name} must be a list of images")
+    return images
+
+
+# readJson
+#
+# Parses a JSON request body
+def readJson(body):
+    try:
+        params = json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPError(400, "The request body must be JSON")
+    if not isinstance(params, dict):
+        raise HTTPError(400, "The request body must be a JSON object")
+    return params
+
+
+# readRequest
+#
+# Reads one HTTP request from a connection
+# Returns (method, path, params, body) with the query string parameters as a dictionary (the relevant
+# parameter is split on commas), or None when the client closed the connection
+async def readRequest(reader):
+    requestLine = await reader.readline()
+    if not requestLine:
+        return None
+
+    try:
+        httpMethod, target, _ = requestLine.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length', 0) or 0)
+    except ValueError:
+        raise HTTPError(400, "Content-Length must be a number")
+    if length < 0:
+        raise HTTPError(400, "Content-Length must not be negative")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, f"Request bodies are limited to {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b""
+
+    url = urlsplit(target)
+    params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+    if 'relevant' in params:
+        params['relevant'] = [image for image in params['relevant'].split(",") if image]
+    return httpMethod.upper(), url.path, params, body
+
+
+# writeResponse
+#
+# Writes a JSON response
+async def writeResponse(writer, status, answer):
+    body = json.dumps(answer).encode()
+    writer.write(f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+    await writer.drain()
+
+
+# serve
+#
+# Starts the server and answers one request per connection until it is stopped
+async def serve(service, host, port, ready=None):
+    async def handleConnection(reader, writer):
+        try:
+            try:
+                request = await readRequest(reader)
+                if request is None:
+                    return
+                status, answer = 200, await service.handle(*request)
+            except HTTPError as error:
+                status, answer = error.status, {'error': str(error)}
+            except asyncio.IncompleteReadError:
+                return
+            except Exception as error:
+                status, answer = 500, {'error': f"{type(error).__name__}: {error}"}
+            await writeResponse(writer, status, answer)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handleConnection, host, port)
+    if ready:
+        ready(server)
+    async with server:
+        await server.serve_forever()
+
+
+# loadIndex
+#
+# Loads the saved feature index into an in-memory image index
+# Returns (imageIndex, graph) with the saved neighbour graph, or None if there is none for this index
+def loadIndex(indexFolder):
+    store = FeatureStore(indexFolder)
+    if not store.paths:
+        raise SystemExit(f"No feature index in {indexFolder}, run python cli.py index first")
+    graph = NeighbourGraph.load(os.path.join(indexFolder, NeighbourGraph.FILE), store.fingerprint)
+    return ImageIndex(store.paths, store.intensity, store.colorCode), graph
+
+
+# main
+#
+# Parses the command line, loads the index and serves until interrupted
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP retrieval service")
+    parser.add_argument("--index-folder", default="index", help="folder holding the feature index")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--batch-window", type=float, default=2.0, help="milliseconds to wait for more queries")
+    parser.add_argument("--max-batch", type=int, default=64, help="most queries in one distance pass")
+    parser.add_argument("--max-sessions", type=int, default=1024, help="most open feedback sessions")
+    args = parser.parse_args(argv)
+
+    imageIndex, graph = loadIndex(args.index_folder)
+    service = QueryService(imageIndex, args.batch_window / 1000, args.max_batch, args.max_sessions, graph)
+
+    def ready(server):
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"Serving {len(service.imageIndex)} images on http://{host}:{port}", file=sys.stderr)
+
+    try:
+        asyncio.run(serve(service, args.host, args.port, ready))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
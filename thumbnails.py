@@ -0,0 +1,114 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+import timing
+
+
+# class ThumbnailCache
+#
+# Size bounded LRU cache of resized images
+#
+# Images are only opened when a thumbnail is first requested, using JPEG draft mode so the decoder
+# produces a reduced size image directly instead of decoding the full resolution first
+# Thumbnails are kept in memory until the total size of the cached pixels goes over the memory budget,
+# at which point the least recently used ones are dropped
+# If a thumbnail folder is given, generated thumbnails are also saved there and reused on later runs
+# The cache can be shared with background threads, decoding happens outside of its lock
+class ThumbnailCache:
+
+    # init
+    #
+    # Sets the memory budget in bytes and the optional folder to persist thumbnails in
+    def __init__(self, maxBytes=64 * 1024 * 1024, thumbnailFolder=None):
+        self.maxBytes = maxBytes
+        self.thumbnailFolder = thumbnailFolder
+        self.cache = OrderedDict()
+        self.currentBytes = 0
+        self.lock = threading.Lock()
+
+    # thumbnailPath
+    #
+    # Returns the file a thumbnail of the given image and size is persisted to
+    def thumbnailPath(self, path, size):
+        key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.thumbnailFolder, f"{size[0]}x{size[1]}", f"{key}.png")
+
+    # loadThumbnail
+    #
+    # Reads a persisted thumbnail if it is newer than its source image, otherwise decodes the image at a
+    # reduced size, resizes it and persists the result
+    def loadThumbnail(self, path, size):
+        with timing.span("load"):
+            savedPath = self.thumbnailPath(path, size) if self.thumbnailFolder else None
+            if savedPath and os.path.exists(savedPath) and os.path.getmtime(savedPath) >= os.path.getmtime(path):
+                with Image.open(savedPath) as img:
+                    return img.convert("RGB")
+
+            with Image.open(path) as img:
+                img.draft("RGB", size)
+                thumbnail = img.convert("RGB").resize(size)
+
+            if savedPath:
+                os.makedirs(os.path.dirname(savedPath), exist_ok=True)
+                temporaryPath = f"{savedPath}.{threading.get_ident()}.tmp"
+                thumbnail.save(temporaryPath, format="PNG")
+                os.replace(temporaryPath, savedPath)
+
+            return thumbnail
+
+    # get
+    #
+    # Returns the thumbnail of the image at path with the given (width, height)
+    # Cache hits are moved to the most recently used end, misses are loaded and may evict old entries
+    def get(self, path, size):
+        thumbnail = self.peek(path, size)
+        if thumbnail is not None:
+            return thumbnail
+
+        key = (path, tuple(size))
+        thumbnail = self.loadThumbnail(path, key[1])
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = thumbnail
+                self.currentBytes += self.imageBytes(thumbnail)
+                self.evict()
+        return thumbnail
+
+    # peek
+    #
+    # Returns the thumbnail if it is already cached, or None without loading anything
+    def peek(self, path, size):
+        key = (path, tuple(size))
+        with self.lock:
+            thumbnail = self.cache.get(key)
+            if thumbnail is not None:
+                self.cache.move_to_end(key)
+            return thumbnail
+
+    # evict
+    #
+    # Drops least recently used thumbnails until the cache fits in its memory budget
+    # The most recent thumbnail is always kept even if it alone is over budget
+    def evict(self):
+        while self.currentBytes > self.maxBytes and len(self.cache) > 1:
+            _, thumbnail = self.cache.popitem(last=False)
+            self.currentBytes -= self.imageBytes(thumbnail)
+
+    # discard
+    #
+    # Removes all cached thumbnails of an image, used when the image changes or is deleted
+    def discard(self, path):
+        with self.lock:
+            for key in [key for key in self.cache if key[0] == path]:
+                self.currentBytes -= self.imageBytes(self.cache.pop(key))
+
+    # imageBytes
+    #
+    # Memory taken by the pixels of an RGB image
+    @staticmethod
+    def imageBytes(img):
+        return img.size[0] * img.size[1] * 3
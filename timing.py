@@ -0,0 +1,145 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# timing
+#
+# Lightweight timing instrumentation for the hot paths of retrieval
+#
+# A Trace collects how much time one user action (a query, a folder refresh, ...) spends in each stage
+# The trace is activated on the thread doing the work, and the instrumented code marks its stages with
+#     with timing.span("distance"):
+#         ...
+# Spans record their exclusive time, so a sort that happens while the grid is rendered is counted as
+# sort and not also as render, and the stages of a trace add up to at most its total time
+# When no trace is active on the thread a span does nothing but a thread-local lookup,
+# so the instrumentation can stay in the code permanently
+#
+# Stages used by the application: queue, load, histogram, normalization, distance, sort and render
+
+STAGES = ("queue", "load", "histogram", "normalization", "distance", "sort", "render")
+
+active = threading.local()
+
+
+# class Trace
+#
+# Per stage timings of one user action
+class Trace:
+
+    # init
+    #
+    # Starts the clock of the action, name describes it in the status area and trace log
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.total = None
+
+    # add
+    #
+    # Adds time to a stage
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    # finish
+    #
+    # Stops the clock of the action
+    def finish(self):
+        self.total = time.perf_counter() - self.start
+        return self
+
+    # breakdown
+    #
+    # Milliseconds spent in every stage, in the usual stage order, plus the total and the untracked rest
+    def breakdown(self):
+        total = self.total if self.total is not None else time.perf_counter() - self.start
+        order = sorted(self.stages, key=lambda stage: STAGES.index(stage) if stage in STAGES else len(STAGES))
+        result = {stage: 1000 * self.stages[stage] for stage in order}
+        result['other'] = max(0.0, 1000 * (total - sum(self.stages.values())))
+        result['total'] = 1000 * total
+        return result
+
+    # summary
+    #
+    # One line description of the breakdown for the status area
+    def summary(self):
+        breakdown = self.breakdown()
+        total = breakdown.pop('total')
+        stages = ", ".join(f"{stage} {ms:.1f}" for stage, ms in breakdown.items() if ms >= 0.05)
+        return f"{self.name}: {total:.1f} ms ({stages})"
+
+    # record
+    #
+    # JSON serializable record of the trace
+    def record(self):
+        return {'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'name': self.name, 'ms': self.breakdown()}
+
+
+# activate
+#
+# Makes a trace the active trace of the current thread for the duration of a with block
+@contextmanager
+def activate(trace):
+    previous = getattr(active, 'trace', None), getattr(active, 'stack', None)
+    active.trace, active.stack = trace, []
+    try:
+        yield trace
+    finally:
+        active.trace, active.stack = previous
+
+
+# span
+#
+# Times a stage of the active trace, excluding the time spent in spans nested inside it
+@contextmanager
+def span(stage):
+    trace = getattr(active, 'trace', None)
+    if trace is None:
+        yield
+        return
+
+    stack = active.stack
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        trace.add(stage, elapsed - nested)
+        if stack:
+            stack[-1] += elapsed
+
+
+# writeTrace
+#
+# Appends a finished trace to a JSON lines log file
+def writeTrace(trace, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(trace.record()) + "\n")
+
+
+# profiled
+#
+# Runs work() under cProfile when a profile folder is given and saves the statistics there as
+# <name>-<n>.prof, to be read with pstats or snakeviz
+# Without a folder work() just runs, so profiling is opt-in
+def profiled(work, profileFolder=None, name="profile"):
+    if not profileFolder:
+        return work()
+
+    os.makedirs(profileFolder, exist_ok=True)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(work)
+    finally:
+        count = len([entry for entry in os.listdir(profileFolder) if entry.startswith(f"{name}-")])
+        profile.dump_stats(os.path.join(profileFolder, f"{name}-{count + 1}.prof"))
@@ -0,0 +1,163 @@
+import queue
+import threading
+
+from extraction import extractHistograms
+from featurestore import FeatureStore, listImages
+
+
+# class FolderWatcher
+#
+# Streaming ingest of an image folder that keeps changing
+#
+# A scan thread polls the folder every interval seconds (plain polling, so it works on any file system
+# without an external service) and compares the size and modification time of every image with the ones
+# it already knows about
+# New and changed images are only picked up once their stamp has stayed the same for a whole interval,
+# so files that are still being written are not decoded half way
+# They flow through a bounded pipeline
+#     scan thread -> path queue -> decoder threads (decode and histograms) -> result queue -> drain()
+# and the consumer applies the drained results to its index, on its own thread and at its own pace
+# Both queues are bounded, so when the decoders fall behind the scan thread waits for them and when the
+# consumer falls behind the decoders wait for it: the memory held by the pipeline stays bounded however
+# fast files arrive, and the backlog stays on disk until the pipeline has room for it
+#
+# An image is never in the pipeline twice, so the results of one image are drained in the order its
+# changes happened, and deletions of images still being decoded are picked up by the next scan
+# A stopped watcher is not restarted, a new one is created instead
+class FolderWatcher:
+
+    # init
+    #
+    # Sets the folder to watch and the (size, mtime) stamps of the images already indexed, the polling
+    # interval in seconds, the number of decoder threads and the size of each queue
+    # Decoding happens on threads since PIL and NumPy release the GIL for the heavy parts, which is plenty
+    # for a stream of files, bulk indexing goes through the process pool of the extraction pipeline
+    def __init__(self, imageFolder, known=None, interval=1.0, workers=2, maxQueued=64):
+        self.imageFolder = imageFolder
+        self.known = dict(known or {})
+        self.interval = interval
+        self.workers = workers
+        self.paths = queue.Queue(maxQueued)
+        self.results = queue.Queue(maxQueued)
+        self.unsettled = {}
+        self.inFlight = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    # start
+    #
+    # Starts the scan thread and the decoder threads
+    def start(self):
+        self.threads = [threading.Thread(target=self.scanLoop, daemon=True)]
+        self.threads += [threading.Thread(target=self.decodeLoop, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    # stop
+    #
+    # Stops every thread of the watcher, blocked threads notice within a tenth of a second
+    def stop(self):
+        self.stopped.set()
+
+    # scanLoop
+    #
+    # Scans the folder every interval seconds until the watcher is stopped
+    def scanLoop(self):
+        while not self.stopped.is_set():
+            try:
+                self.scan()
+            except OSError:
+                pass  # The folder is missing for now, try again at the next scan
+            self.stopped.wait(self.interval)
+
+    # scan
+    #
+    # Compares the folder with the known images and queues the deleted, new and changed ones
+    # Images still in the pipeline are left for a later scan
+    def scan(self):
+        stamps = {}
+        for path in listImages(self.imageFolder):
+            try:
+                stamp = FeatureStore.fileStamp(path)
+            except OSError:
+                continue  # Deleted between listing and stat
+            stamps[path] = (stamp['size'], stamp['mtime'])
+
+        with self.lock:
+            busy = set(self.inFlight)
+
+        for path in [path for path in self.known if path not in stamps and path not in busy]:
+            del self.known[path]
+            if not self.put(self.results, ("remove", path, None, None)):
+                return
+
+        self.unsettled = {path: stamp for path, stamp in self.unsettled.items() if path in stamps}
+        for path, stamp in stamps.items():
+            if self.known.get(path) == stamp or path in busy:
+                continue
+            if self.unsettled.get(path) != stamp:
+                self.unsettled[path] = stamp
+                continue
+
+            del self.unsettled[path]
+            kind = "change" if path in self.known else "add"
+            self.known[path] = stamp
+            with self.lock:
+                self.inFlight.add(path)
+            if not self.put(self.paths, (kind, path, stamp)):
+                return
+
+    # decodeLoop
+    #
+    # Decodes queued images and queues their histograms until the watcher is stopped
+    # Images that can no longer be read get None histograms, a later change of the file is picked up again
+    def decodeLoop(self):
+        while not self.stopped.is_set():
+            try:
+                kind, path, stamp = self.paths.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            try:
+                histograms = extractHistograms(path)
+            except (OSError, ValueError):
+                histograms = None
+            self.put(self.results, (kind, path, stamp, histograms))
+            with self.lock:
+                self.inFlight.discard(path)
+
+    # put
+    #
+    # Puts an item on a bounded queue, waiting for room unless the watcher is stopped
+    # Returns whether the item was queued
+    def put(self, target, item):
+        while not self.stopped.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # drain
+    #
+    # Takes up to maxItems finished results off the pipeline without waiting
+    # Every result is a tuple (kind, path, stamp, histograms) with kind "add", "change" or "remove",
+    # histograms is the (intensity, colorCode) tuple, or None for removals and images that could not be decoded
+    def drain(self, maxItems=64):
+        items = []
+        while len(items) < maxItems:
+            try:
+                items.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    # backlog
+    #
+    # Number of images waiting in the pipeline or for their stamp to settle
+    def backlog(self):
+        with self.lock:
+            return len(self.inFlight) + self.results.qsize() + len(self.unsettled)